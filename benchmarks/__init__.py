@@ -0,0 +1,13 @@
+# Copyright 2019 Mingxuan Lin
+"""
+Offline benchmarks of the hot paths of ipycondor
+
+The HTCondor daemons are replaced by the in-process fake of `fake_htcondor`,
+so the benchmarks run on any machine with pandas and ipywidgets installed.
+
+Usage:
+    python -m benchmarks --sizes 1000,100000 --output results.json
+    python -m benchmarks --sizes 1000 --compare results.json
+    python benchmarks/bench_import.py
+    python benchmarks/check_tables.py
+"""
@@ -0,0 +1,97 @@
+# Copyright 2019 Mingxuan Lin
+" Run the offline benchmarks, see benchmarks/__init__.py "
+import sys, json, time, types, logging, argparse, platform, subprocess, inspect
+
+from . import fake_htcondor
+
+FORMAT_VERSION = 1
+
+def timeit(f, repeat=3):
+    times = []
+    for i in range(repeat): #pylint: disable=W0612
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times)//2], 'repeat': repeat}
+
+def cases(n):
+    """ Benchmark cases for a pool of `n` jobs and `n` slots as (name, callable) """
+    from ipycondor.Condor import Condor, TabView, LogHandler, deep_parse
+    cdr = Condor()
+    cdr.cache.ttl = 0 # every call queries the fake schedd
+    defaults = lambda f: {k:p.default for k,p in inspect.signature(f).parameters.items()}
+    jobs, machines = defaults(Condor.job_table), defaults(Condor.machine_table)
+    job_cols = tuple(jobs['index']) + tuple(c for c in jobs['columns'] if c not in jobs['index'])
+
+    ads = cdr.jobs('', job_cols)
+    yield 'deep_parse', lambda: deep_parse(ads, job_cols)
+
+    getdf = Condor._wrap_tab_hdl(cdr.jobs, '', jobs['columns'], jobs['index'], schema=Condor.job_schema)
+    yield 'getdf/jobs', getdf
+    yield 'getdf/machines', Condor._wrap_tab_hdl(cdr.machines, '', machines['columns'], machines['index'],
+                                                 schema=Condor.machine_schema)
+
+    view = TabView.__new__(TabView)
+    view.f = getdf
+    view.df = getdf()
+    view.grid_widget = types.SimpleNamespace(df=view.df)
+    view._update = TabView._update.__get__(view)
+    view.updated_at = types.SimpleNamespace(value='')
+    view.log = logging.getLogger('benchmarks')
+    view._update(*view._fetch()) # the fingerprint of the table shown
+    yield 'refresh/unchanged', view._fetch
+
+    job_ids = [{'ClusterID':j['ClusterId'], 'ProcID':j['ProcId']} for j in ads[:5000]]
+    yield 'job_actions/5000', lambda: cdr.job_actions('Hold', job_ids)
+
+    handler = LogHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s  - [%(levelname)s] %(message)s'))
+    records = [logging.makeLogRecord({'msg':'record %d', 'args':(i,), 'levelname':'INFO'}) for i in range(1000)]
+    yield 'LogHandler.emit/1000', lambda: [handler.emit(r) for r in records]
+
+def meta():
+    try:
+        rev = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                      stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        rev = 'unknown'
+    return {'revision': rev, 'python': platform.python_version(), 'platform': platform.platform()}
+
+def run(sizes, repeat):
+    results = {}
+    for n in sizes:
+        fake_htcondor.resize(n, n)
+        for name, f in cases(n):
+            key = '%s@%d' % (name, n)
+            results[key] = timeit(f, repeat)
+            print('%-32s %10.4fs' % (key, results[key]['best']), flush=True)
+    return results
+
+def compare(results, baseline):
+    print('%-32s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for key in sorted(results):
+        if key in baseline:
+            b, c = baseline[key]['best'], results[key]['best']
+            print('%-32s %10.4f %10.4f %8.2f' % (key, b, c, c/b if b else float('nan')))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Offline benchmarks of ipycondor')
+    parser.add_argument('--sizes', default='1000,100000', help='comma separated numbers of jobs and slots, e.g. 1000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args(argv)
+
+    fake_htcondor.install(0, 0)
+    results = run([int(n) for n in args.sizes.split(',')], args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'format': FORMAT_VERSION, 'meta': meta(), 'results': results}, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
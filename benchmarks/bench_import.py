@@ -0,0 +1,74 @@
+# Copyright 2019 Mingxuan Lin
+"""
+Import time regression benchmark of the ipycondor package
+
+Usage:
+    python benchmarks/bench_import.py [--repeat 5] [--max-seconds 2.0]
+
+Each import is timed in a fresh interpreter. The benchmark fails if any of the
+heavy modules is imported by `import ipycondor`, if the best import time
+exceeds --max-seconds, or if `from ipycondor import Condor` does not return the
+class after `%CondorMon` (with the fake htcondor of the benchmarks).
+"""
+import os, sys, json, argparse, subprocess
+
+# Modules which must only be imported when the dashboard is used
+HEAVY = ('htcondor', 'classad', 'ipywidgets', 'pandas', 'qgrid', 'ipyparallel')
+
+CODE = """
+import sys, time, json
+t0 = time.perf_counter()
+import ipycondor
+t1 = time.perf_counter()
+print(json.dumps({'seconds': t1-t0, 'heavy': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY,)
+
+# `%CondorMon` followed by `from ipycondor import Condor; ui=Condor()`, as in the example notebook
+BINDING = """
+import sys
+sys.path.insert(0, %r)
+from benchmarks import fake_htcondor
+fake_htcondor.install(10, 10)
+from ipycondor.magics import CondorMagics
+CondorMagics.__new__(CondorMagics).condor # what %%CondorMon displays
+from ipycondor import Condor
+ui = Condor()
+print(type(ui).__name__)
+""" % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))),)
+
+def check_binding():
+    " None if `ipycondor.Condor` is the class after %CondorMon, else the error "
+    p = subprocess.run([sys.executable, '-c', BINDING], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.stdout.decode(errors='replace').strip()
+    return None if p.returncode == 0 and out.endswith('Condor') else out
+
+def measure(repeat=5):
+    runs = []
+    for i in range(repeat): #pylint: disable=W0612
+        out = subprocess.check_output([sys.executable, '-c', CODE])
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+    return {'best': min(r['seconds'] for r in runs),
+            'median': sorted(r['seconds'] for r in runs)[len(runs)//2],
+            'heavy': sorted(set(m for r in runs for m in r['heavy']))}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args(argv)
+    res = measure(args.repeat)
+    print(json.dumps(res, indent=1, sort_keys=True))
+    if res['heavy']:
+        print('Regression: `import ipycondor` imports %s' % ', '.join(res['heavy']))
+        return 1
+    if args.max_seconds is not None and res['best'] > args.max_seconds:
+        print('Regression: `import ipycondor` takes %.3fs' % res['best'])
+        return 1
+    err = check_binding()
+    if err:
+        print('Regression: `from ipycondor import Condor` after %%CondorMon fails\n%s' % err)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# Copyright 2019 Mingxuan Lin
+"""
+Correctness checks of the table diffs, run before trusting the benchmarks
+
+Usage:
+    python benchmarks/check_tables.py
+"""
+import os, sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipycondor.tables import diff, upsert #pylint: disable=C0413
+
+def check_categorical_diff():
+    " The categories of a column are rebuilt on each refresh, only its values count "
+    old = pd.DataFrame({'owner': pd.Categorical(['x', 'y', 'x']), 'st': [1, 2, 1]}, index=[1, 2, 3])
+    new = pd.DataFrame({'owner': pd.Categorical(['x', 'y', 'x', 'w']), 'st': [1, 2, 2, 1]}, index=[1, 2, 3, 4])
+    d = diff(old, new)
+    assert list(d.inserted) == [4] and list(d.changed) == [3], d
+    assert d.columns == ['st'], d.columns
+
+def check_upsert_diff():
+    " Rows upserted from an incremental query, with a NaN RemoteHost of idle jobs "
+    cat = lambda v: pd.Categorical(v)
+    old = pd.DataFrame({'RemoteHost': cat(['a', None, 'b']), 'JobStatus': cat([2, 1, 2])}, index=[1, 2, 3])
+    rows = pd.DataFrame({'RemoteHost': cat(['b']), 'JobStatus': cat([5])}, index=[3])
+    d = diff(old, upsert(old, rows))
+    assert list(d.changed) == [3] and d.columns == ['JobStatus'], d
+
+def main():
+    for check in (check_categorical_diff, check_upsert_diff):
+        check()
+        print('%s: ok' % check.__name__)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# Copyright 2019 Mingxuan Lin
+"""
+In-process stand-in for the `htcondor` and `classad` python bindings
+
+Schedd and Collector serve synthetic ClassAds of a pool with a given number
+of jobs and slots, with attribute counts similar to those of a real pool.
+Constraints are not evaluated (except for the job IDs of Schedd.act);
+projections and query limits are applied.
+
+Usage:
+    from benchmarks import fake_htcondor
+    fake_htcondor.install(n_jobs=1000, n_slots=1000)
+    import htcondor   # the fake module
+"""
+import sys, time, types, enum, random
+
+N_JOB_ATTRS  = 90
+N_SLOT_ATTRS = 120
+
+OWNERS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi']
+
+class ClassAd(dict):
+    """ dict with case-insensitive keys, as classad.ClassAd """
+    __slots__ = ()
+    def __init__(self, attrs=()):
+        super().__init__((k.lower(), v) for k, v in dict(attrs).items())
+    def __getitem__(self, k):
+        return super().__getitem__(k.lower())
+    def __setitem__(self, k, v):
+        super().__setitem__(k.lower(), v)
+    def __contains__(self, k):
+        return super().__contains__(k.lower())
+    def get(self, k, default=None):
+        return super().get(k.lower(), default)
+
+class ExprTree(object):
+    def __init__(self, expr):
+        self.expr = str(expr)
+    def __eq__(self, other):
+        return ExprTree('(%s == %r)' % (self.expr, other))
+    def and_(self, other):
+        return ExprTree('(%s && %s)' % (self.expr, other))
+    def __str__(self):
+        return self.expr
+    __hash__ = object.__hash__
+
+def _paddings(rng, n, prefix, variants=64):
+    " Filler attributes (with lower-case names) shared by the synthetic ads "
+    return [{('%s%03d' % (prefix, i)).lower(): rng.choice((rng.randint(0, 1<<20), 'value-%d' % rng.randint(0, 999), True))
+             for i in range(n)} for _ in range(variants)]
+
+def make_jobs(n, seed=0):
+    rng = random.Random(seed)
+    now = int(time.time())
+    pads = None
+    jobs = []
+    for i in range(n):
+        cluster, proc = 1000 + i//10, i%10
+        status = rng.choice((1, 1, 2, 2, 2, 5, 4))
+        owner  = rng.choice(OWNERS)
+        start  = now - rng.randint(0, 86400) if status != 1 else 0
+        ad = {
+            'ClusterId': cluster, 'ProcId': proc, 'Owner': owner, 'JobStatus': status,
+            'JobUniverse': rng.choice((5, 5, 5, 7, 11, 12)),
+            'JobDescription': 'job-%d' % cluster, 'QDate': now - 90000,
+            'EnteredCurrentStatus': now - rng.randint(0, 3600),
+            'JobStartDate': start, 'CompletionDate': 0,
+            'GlobalJobId': 'submit.example.org#%d.%d#%d' % (cluster, proc, now),
+            'RemoteHost': 'slot1_%d@node%03d.example.org' % (rng.randint(1, 32), rng.randint(0, 499)) if status == 2 else None,
+            'LastRemoteHost': 'slot1@node%03d.example.org' % rng.randint(0, 499),
+            'RequestMemory': rng.choice((1024, 2048, 4096)), 'RequestCpus': rng.choice((1, 1, 2, 4)),
+            'RequestDisk': rng.randint(1, 1<<22), 'DiskUsage': rng.randint(1, 1<<20),
+            'ImageSize': rng.randint(1, 1<<22), 'ExitStatus': 0,
+            'UserLog': '/home/%s/job.log' % owner, 'Iwd': '/home/%s' % owner,
+        }
+        pads = pads or _paddings(rng, N_JOB_ATTRS - len(ad), 'JobAttr')
+        ad = ClassAd(ad)
+        dict.update(ad, pads[i % len(pads)])
+        jobs.append(ad)
+    return jobs
+
+def make_slots(n, seed=0):
+    rng = random.Random(seed)
+    pads = None
+    slots = []
+    for i in range(n):
+        machine = 'node%03d.example.org' % (i//32)
+        partitionable = (i%32 == 0)
+        claimed = not partitionable and rng.random() < 0.7
+        ad = {
+            'MyType': 'Machine', 'Machine': machine, 'Name': 'slot%d@%s' % (i%32+1, machine),
+            'SlotID': i%32+1, 'SlotType': 'Partitionable' if partitionable else 'Dynamic',
+            'PartitionableSlot': partitionable, 'DynamicSlot': not partitionable,
+            'State': 'Claimed' if claimed else 'Unclaimed', 'Activity': 'Busy' if claimed else 'Idle',
+            'Cpus': rng.choice((1, 2, 4)), 'Memory': rng.choice((2048, 4096, 8192)),
+            'Disk': rng.randint(1<<20, 1<<24), 'LoadAvg': rng.random(),
+            'TotalSlots': 32, 'TotalCpus': 64, 'TotalMemory': 256*1024,
+            'TotalDisk': 1<<30, 'TotalLoadAvg': rng.random()*64,
+            'RemoteOwner': rng.choice(OWNERS) if claimed else None,
+        }
+        pads = pads or _paddings(rng, N_SLOT_ATTRS - len(ad), 'SlotAttr')
+        ad = ClassAd(ad)
+        dict.update(ad, pads[i % len(pads)])
+        slots.append(ad)
+    return slots
+
+def _project(ads, projection, limit=-1):
+    if limit is not None and limit >= 0:
+        ads = ads[:limit]
+    if not projection:
+        return list(ads)
+    keys = [k.lower() for k in projection]
+    out = []
+    for ad in ads:
+        p = ClassAd()
+        for k in keys:
+            if k in ad:
+                dict.__setitem__(p, k, dict.__getitem__(ad, k))
+        out.append(p)
+    return out
+
+class Schedd(object):
+    jobs = []
+    def __init__(self, location=None):
+        self.location = location
+    def query(self, constraint='true', projection=(), callback=None, limit=-1, opts=None):
+        return _project(self.jobs, projection, limit)
+    def xquery(self, constraint='true', projection=(), limit=-1, opts=None, name=None):
+        return iter(self.query(constraint, projection, limit=limit))
+    def history(self, constraint='true', projection=(), match=-1, since=None):
+        return iter(_project(self.jobs, projection, match))
+    def act(self, action, job_spec):
+        res = ClassAd({'TotalSuccess':0, 'TotalNotFound':0, 'TotalError':0,
+                       'TotalBadStatus':0, 'TotalAlreadyDone':0, 'TotalPermissionDenied':0})
+        # Like the bindings, only the totals are returned
+        ids = job_spec if isinstance(job_spec, (list, tuple)) else ()
+        res['TotalSuccess'] = len(ids) if ids else len(self.jobs)
+        return res
+
+class Collector(object):
+    slots = []
+    def __init__(self, pool=None):
+        self.pool = pool
+    def query(self, ad_type=None, constraint='', projection=(), statistics=''):
+        return _project(self.slots, projection)
+    def locate(self, daemon_type, name=None):
+        return ClassAd({'MyType': 'Scheduler', 'Name': name or 'submit.example.org'})
+    def locateAll(self, daemon_type):
+        return [self.locate(daemon_type)]
+
+def install(n_jobs=1000, n_slots=1000, seed=0):
+    """ Install the fake `htcondor` and `classad` modules into sys.modules """
+    classad = types.ModuleType('classad')
+    classad.ClassAd  = ClassAd
+    classad.ExprTree = ExprTree
+
+    htcondor = types.ModuleType('htcondor')
+    htcondor.Schedd    = Schedd
+    htcondor.Collector = Collector
+    htcondor.JobAction   = enum.Enum('JobAction', 'Hold Release Remove RemoveX Vacate VacateFast Suspend Continue')
+    htcondor.DaemonTypes = enum.Enum('DaemonTypes', 'Any Master Schedd Collector Negotiator Startd Credd Generic HAD')
+    htcondor.AdTypes     = enum.Enum('AdTypes', 'Any Generic Startd Schedd Negotiator Collector Master')
+    htcondor.JobEventType = enum.Enum('JobEventType', 'SUBMIT EXECUTE EXECUTABLE_ERROR CHECKPOINTED JOB_EVICTED '
+        'JOB_TERMINATED IMAGE_SIZE SHADOW_EXCEPTION GENERIC JOB_ABORTED JOB_SUSPENDED JOB_UNSUSPENDED '
+        'JOB_HELD JOB_RELEASED')
+    sys.modules['classad']  = classad
+    sys.modules['htcondor'] = htcondor
+    resize(n_jobs, n_slots, seed)
+    return htcondor
+
+def resize(n_jobs, n_slots, seed=0):
+    """ Regenerate the jobs and slots served by the fake daemons """
+    Schedd.jobs     = make_jobs(n_jobs, seed)
+    Collector.slots = make_slots(n_slots, seed)
@@ -1,6 +1,12 @@
 # Copyright 2019 Mingxuan Lin
 " Parsers for ClassAd objects "
-import copy, re
+import copy, re, inspect
+
+# Values of these types are shared without copying
+_IMMUTABLE = (type(None), bool, int, float, str, bytes)
+
+JOB_STATUS = ['Idle','Running','Removed','Completed','Held','Transferring Output','Suspended']
+JOB_UNIVERSES = {1:'standard', 5:'vanilla', 7:'scheduler', 8:'MPI', 9:'grid', 10:'java', 11:'parallel', 12:'local', 13:'vm'}
 
 def _naturalsize(value, scale=1):
     try:
@@ -9,7 +15,63 @@ def _naturalsize(value, scale=1):
     except Exception:
         return value
 
-def rule(x, plain=False):
+def _bulk_naturalsize(values, scale=1):
+    " _naturalsize of a pandas.Series, evaluated once per distinct value "
+    uniq = values.dropna().unique()
+    return values.map({v:_naturalsize(v, scale) for v in uniq})
+
+class Bytes(object):
+    """
+    Column type of a schema for byte counts, which are given in units of
+    `scale` bytes by the ClassAds. The column holds the raw number of bytes
+    as int64 and is humanized only for display (see `humanize`).
+    """
+    def __init__(self, scale=1):
+        self.scale = scale
+
+    def __repr__(self):
+        return 'Bytes(%d)' % self.scale
+
+def _lower_keys(schema):
+    return {k.lower():v for k, v in (schema or {}).items()}
+
+def apply_schema(df, schema):
+    """
+    Convert the columns of `df` to the types of `schema`, a dict of column
+    name to a numpy/pandas dtype or `Bytes`. Integer columns with missing
+    values become the nullable integer type.
+    """
+    import pandas as pd
+    types = _lower_keys(schema)
+    for c in df.columns:
+        t = types.get(c.lower(), None)
+        if t is None:
+            continue
+        col = df[c]
+        if isinstance(t, Bytes):
+            col = pd.to_numeric(col, errors='coerce') * t.scale
+            df[c] = col if col.isna().any() else col.astype('int64')
+        elif str(t).startswith(('int', 'uint', 'float')):
+            col = pd.to_numeric(col, errors='coerce')
+            if not str(t).startswith('float') and col.isna().any():
+                t = str(t).replace('uint', 'UInt').replace('int', 'Int')
+            df[c] = col.astype(t)
+        elif col.dtype != t:
+            df[c] = col.astype(t)
+    return df
+
+def humanize(df, schema):
+    " Copy of `df` with the `Bytes` columns of `schema` rendered as human readable strings "
+    types = _lower_keys(schema)
+    cols = [c for c in df.columns if isinstance(types.get(c.lower(), None), Bytes)]
+    if not cols:
+        return df
+    df = df.copy()
+    for c in cols:
+        df[c] = _bulk_naturalsize(df[c])
+    return df
+
+def rule(x=None, plain=False, depends=()):
     """
     Decorater for class method of a BaseParser subclass
     Used together with BaseParser.meta
@@ -19,6 +81,9 @@ def rule(x, plain=False):
         def rulename(value, key, classad_object):
             return value
 
+    Attributes read from `classad_object` other than `key` itself should be
+    declared with `depends`, so that they are included in query projections:
+        @rule(depends=('GlobalJobId',))
     """
     pt = None
     if isinstance(x, str):
@@ -30,10 +95,26 @@ def rule(x, plain=False):
     def decorater(f):
         f._meta_type = "parser_rule"
         f.pattern     = pt if pt else f.__name__
+        f.depends     = tuple(depends)
         return f
 
     return decorater(x) if callable(x) else decorater
 
+def vectorized(scalar_rule):
+    """
+    Decorater registering the column-wise equivalent of a rule,
+    which is used by ParsePlan.to_frame instead of calling the rule per value
+
+    Usage:
+        @vectorized(rulename)
+        def _rulename(series, key, raw_frame):
+            return series
+    """
+    def decorater(f):
+        scalar_rule.vectorized = f
+        return f
+    return decorater
+
 
 class BaseParser(object):
     """
@@ -47,13 +128,18 @@ class BaseParser(object):
                 return lookuptable[v-1]
         p = ClassAdParser()
         p.parse(jobClassAd, 'JobStatus')
+        # or with the rules resolved once for a list of columns
+        plan = p.compile(['ClusterId', 'JobStatus'])
+        rows = [plan(ad) for ad in jobClassAds]
     """
     __simple_rules = {}
     __re_rules = tuple()
+    __chains = {}
     @staticmethod
     def meta(cls):
         cls.__simple_rules = {}
         cls.__re_rules = []
+        cls.__chains = {}
         for n in dir(cls):
             if n.startswith('_'): continue
             func = getattr(cls, n)
@@ -65,6 +151,50 @@ class BaseParser(object):
                 cls.__re_rules.append([pattern, func])
         return cls
 
+    @classmethod
+    def rules(cls, key):
+        """ Rules matching the attribute `key` in the order they are applied """
+        srule = cls.__simple_rules.get(key.lower(), None)
+        if srule:
+            yield srule
+        for pt, srule in cls.__re_rules:
+            if pt.match(key):
+                yield srule
+
+    @classmethod
+    def projection(cls, columns):
+        """
+        Attribute names to be queried for parsing `columns`,
+        i.e. the columns themselves and the dependencies of their rules
+        """
+        attrs = list(columns)
+        known = set(a.lower() for a in attrs)
+        for key in columns:
+            for f in cls.rules(key):
+                for a in getattr(f, 'depends', ()):
+                    if a.lower() not in known:
+                        known.add(a.lower())
+                        attrs.append(a)
+        return attrs
+
+    @classmethod
+    def chain(cls, key):
+        """ Rules of the attribute `key` as a tuple of (rule, number of arguments) """
+        c = cls.__chains.get(key, None)
+        if c is None:
+            c = cls.__chains[key] = tuple((f, _arity(f)) for f in cls.rules(key))
+        return c
+
+    def compile(self, columns, schema=None):
+        """
+        Resolve the rules of `columns` once for parsing many ClassAd objects
+
+        :param columns: names of the attributes
+        :param schema: column types of the frames, see apply_schema
+        :rtype: ParsePlan
+        """
+        return ParsePlan(self, columns, schema)
+
     def parse(self, clsad, key):
         """
         Parse the value of the named attribute of a ClassAd object `clsad[key]`.
@@ -75,28 +205,73 @@ class BaseParser(object):
         :type  key: string
         :rtype: string
         """
-        value = copy.deepcopy(clsad.get(key, None))
-        srule=self.__simple_rules.get(key.lower(), None)
-        if srule:
-            value = _safe_call( srule, value , key , clsad)
-            if value: return value
-        for pt, srule in self.__re_rules:
-            if pt.match(key):
-                value = _safe_call( srule, value , key , clsad)
-                if value: return value
-        # No match
-        if type(value).__module__ == 'classad':
-            value = str(value)
-        return value
+        return _apply(self.chain(key), clsad, key)
 
-def _safe_call(f, *args):
-    import inspect
-    n = len(inspect.getfullargspec(f).args) # support python>3.0
-    args = args[:n]
-    try:
-        return f(*args)
-    except Exception as err:
-        return str(err)
+class ParsePlan(object):
+    """
+    Rules of a parser resolved for a fixed list of columns (see BaseParser.compile)
+    Calling the plan with a ClassAd object returns a dict of the parsed columns.
+    The rules of the `Bytes` columns of the schema are skipped.
+    """
+    def __init__(self, parser, columns, schema=None):
+        self.columns = tuple(columns)
+        self.schema  = dict(schema or {})
+        self.attrs   = tuple(parser.projection(self.columns))
+        types = _lower_keys(schema)
+        self.chains  = tuple((c, () if isinstance(types.get(c.lower(), None), Bytes) else parser.chain(c))
+                             for c in self.columns)
+
+    def __call__(self, clsad):
+        return {key:_apply(chain, clsad, key) for key, chain in self.chains}
+
+    def to_frame(self, classAds):
+        """
+        Parse ClassAd objects column by column into a pandas.DataFrame.
+        The raw attribute values are extracted first, then the vectorized
+        equivalents of the rules are applied to whole columns.
+        Columns with rules that are not vectorized fall back to the scalar rules.
+
+        :param classAds: iterable of ClassAd objects
+        :rtype: pandas.DataFrame
+        """
+        import pandas as pd
+        classAds = classAds if isinstance(classAds, list) else list(classAds)
+        raw = pd.DataFrame({a:[j.get(a, None) for j in classAds] for a in self.attrs},
+                           columns=self.attrs)
+        data = {}
+        for key, chain in self.chains:
+            vf = getattr(chain[0][0], 'vectorized', None) if len(chain) == 1 else None
+            if not chain:
+                data[key] = _plain(raw[key])
+            elif vf:
+                data[key] = vf(*(raw[key], key, raw)[:_arity(vf)])
+            else:
+                data[key] = [_apply(chain, j, key) for j in classAds]
+        df = pd.DataFrame(data, columns=self.columns)
+        return apply_schema(df, self.schema) if self.schema else df
+
+def _plain(values):
+    if values.dtype == object and any(type(v).__module__ == 'classad' for v in values):
+        return values.map(lambda v: str(v) if type(v).__module__ == 'classad' else v)
+    return values
+
+def _apply(chain, clsad, key):
+    value = clsad.get(key, None)
+    if not isinstance(value, _IMMUTABLE):
+        value = copy.deepcopy(value)
+    for f, n in chain:
+        try:
+            value = f(*(value, key, clsad)[:n])
+        except Exception as err:
+            value = str(err)
+        if value: return value
+    # No match
+    if type(value).__module__ == 'classad':
+        value = str(value)
+    return value
+
+def _arity(f):
+    return len(inspect.getfullargspec(f).args) # support python>3.0
 
 @BaseParser.meta
 class QueryParser(BaseParser):
@@ -105,13 +280,22 @@ class QueryParser(BaseParser):
     """
     @rule
     def JobUniverse(value):
-        Universes={1:'standard', 5:'vanilla', 7:'scheduler', 8:'MPI', 9:'grid', 10:'java', 11:'parallel', 12:'local', 13:'vm'}
-        return Universes.get(value, 'unknown')
+        return JOB_UNIVERSES.get(value, 'unknown')
+
+    @vectorized(JobUniverse)
+    def _JobUniverse(series):
+        return series.map(JOB_UNIVERSES).fillna('unknown').astype('category')
 
     @rule
     def JobStatus(value, k, clsad):
-        S=['Idle','Running','Removed','Completed','Held','Transferring Output','Suspended']
-        return S[value-1]
+        return JOB_STATUS[value-1]
+
+    @vectorized(JobStatus)
+    def _JobStatus(series):
+        import pandas as pd
+        codes = pd.to_numeric(series, errors='coerce').fillna(0).astype(int) - 1
+        codes = codes.where((codes >= 0) & (codes < len(JOB_STATUS)), -1)
+        return pd.Categorical.from_codes(codes, JOB_STATUS)
 
     @rule
     def DiskUsage(value):
@@ -124,15 +308,24 @@ class QueryParser(BaseParser):
             return datetime.datetime.fromtimestamp(value)
         return None
 
-    @rule
+    @vectorized(timestamp2date)
+    def _timestamp2date(series):
+        import pandas as pd
+        from dateutil.tz import gettz
+        ts = pd.to_numeric(series, errors='coerce')
+        dates = pd.to_datetime(ts.where(ts > 0), unit='s', utc=True)
+        # The tzfile of the local zone is converted in bulk, unlike tzlocal() which is applied per element
+        return dates.dt.tz_convert(gettz()).dt.tz_localize(None)
+
+    @rule(depends=('LastRemoteHost',))
     def RemoteHost(value, k, clsad):
         return value if value else clsad.get('LastRemoteHost','')
 
-    @rule
+    @rule(depends=('GlobalJobId',))
     def JobId(value, key, clsad):
         return clsad.get('GlobalJobId', '').split('#')[1]
 
-    @rule
+    @rule(depends=('CompletionDate',))
     def ExitStatus(value, key, clsad):
         if clsad.get('CompletionDate','') > 0:
             return value
@@ -142,6 +335,14 @@ class QueryParser(BaseParser):
     def mbyte2human(value):
         return _naturalsize(value, 1024*1024 )
 
+    @vectorized(mbyte2human)
+    def _mbyte2human(series):
+        return _bulk_naturalsize(series, 1024*1024)
+
     @rule(r'\w*(Disk)$')
     def kbyte2human(value):
         return _naturalsize(value, 1024 )
+
+    @vectorized(kbyte2human)
+    def _kbyte2human(series):
+        return _bulk_naturalsize(series, 1024)
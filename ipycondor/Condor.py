@@ -1,18 +1,22 @@
 # Copyright 2019 Mingxuan Lin
 # Copyright 2019 Lukas Koschmieder
 
-import os, time, logging, re, datetime, asyncio
-from subprocess import Popen, PIPE
+import os, time, logging, re, datetime, asyncio, threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import htcondor
 
-from IPython.core.magic import (Magics, magics_class, line_magic, cell_magic)
 from IPython.display import display
 
 import ipywidgets
 
-from .ClassAdParser import QueryParser
-from .ipcluster import NbIPClusterStart
+from .ClassAdParser import QueryParser, Bytes, humanize
+from .tables import indexed, diff, IncrementalTable, PagedTable, HistoryTable
+from .cache import QueryCache, HostInventory
+from .snapshot import SnapshotStore, SnapshotTable
+# Still loadable as the extension `ipycondor.Condor`
+from .magics import CondorMagics, load_ipython_extension #pylint: disable=W0611
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -41,26 +45,64 @@ def my_job_id():
         logger.debug('%s\n\tJupyterlab is not started by HTCondor.', str(err))
         return None
 
+# Whether an action has been applied to a job of JobStatus (None if the job has left)
+ACTION_APPLIED = {'Hold':     lambda st: st == 5,
+                  'Release':  lambda st: st not in (None, 5),
+                  'Suspend':  lambda st: st == 7,
+                  'Continue': lambda st: st not in (None, 7),
+                  'Remove':   lambda st: st in (None, 3)}
+
+def _job_expr(job_argv):
+    et = ExprTree('True')
+    for k,v in job_argv.items():
+        et = et.and_( ExprTree(k) == v )
+    return str(et)
+
+def _job_id(job_argv):
+    " 'ClusterId.ProcId' of a job or None "
+    a = {k.lower():v for k,v in job_argv.items()}
+    if len(a)==2 and 'clusterid' in a and 'procid' in a:
+        return '%d.%d' % (a['clusterid'], a['procid'])
+    return None
+
+def _bind_schedd_name(constraint, name):
+    " A schedd knows not its name in the job ads "
+    if name is None:
+        return constraint
+    return re.sub(r'\bScheddName\b', '"%s"' % name, constraint, flags=re.IGNORECASE)
+
 def deep_parse(classAds, cols=None):
     parser=QueryParser()
     if cols:
-        data = [{c:parser.parse(j, c) for c in cols} for j in classAds]
+        plan = parser.compile(cols)
+        data = [plan(j) for j in classAds]
     else:
         data = [{c:parser.parse(j, c) for c in j} for j in classAds]
     return data if len(data)>0 else None
 
+_executor = None
+def executor():
+    " Thread pool for the queries running in the background "
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ipycondor')
+    return _executor
+
 def lHBox (x):
     return ipywidgets.HBox(x, layout={'justify_content':'flex-end'} )
 
 class TabView(object):
     refresh_timer = None
-    def __init__(self, f, log=logger):
+    grid_options  = {'editable':False, 'minVisibleRows':10, 'maxVisibleRows':8}
+    def __init__(self, f, log=logger, interval=2, schema=None):
+        """ schema: column types of the table, whose Bytes columns are humanized for display """
         self.f   = f
         self.log = log
-        self.grid_widget = qgrid.show_grid(f(),show_toolbar=False,
-                                    grid_options={'editable':False,
-                                                  'minVisibleRows':10,
-                                                  'maxVisibleRows':8})
+        self.interval = interval
+        self.schema = schema
+        self.df = f()
+        self.grid_widget = qgrid.show_grid(humanize(self.df, schema),show_toolbar=False,
+                                    grid_options=self.grid_options)
 
         refresh_btn = ipywidgets.ToggleButton(
             value=False, description='Refresh', disabled=False,
@@ -70,8 +112,13 @@ class TabView(object):
         refresh_btn.observe(self.refresh_btn_handler)
         self.refresh_btn=refresh_btn
 
-        self.updated_at = ipywidgets.HTML( value='<i>%s</i>' % datetime.datetime.now(),
+        self.updated_at = ipywidgets.HTML( value='<i>%s</i> %s' % (datetime.datetime.now(), self.memory_usage()),
           description='Updated at')
+        snapshot_time = getattr(f, 'snapshot_time', None)
+        if snapshot_time:
+            self.updated_at.value = '<i>%s (snapshot)</i>' % snapshot_time
+            # Reconcile the snapshot with the daemons in the background
+            self.request_refresh()
 
     def refresh_btn_handler(self, evt):
         btn = evt.owner
@@ -81,7 +128,7 @@ class TabView(object):
             assert isinstance(btn, ipywidgets.ToggleButton), 'Illegal usage of refresh_btn_handler'
             if btn.value:
                 self.refreshing_id = self.refreshing_id + 1
-                asyncio.ensure_future(self.periodic_refresh(self.refreshing_id, 2))
+                asyncio.ensure_future(self.periodic_refresh(self.refreshing_id, self.interval))
         except Exception as err:
             self.log.error('Failed switch on/off auto refresh because of %s', repr(err))
 
@@ -89,19 +136,89 @@ class TabView(object):
     async def periodic_refresh(self, refreshing_id, delay=2):
         try:
             while self.refresh_btn.value and self.refreshing_id == refreshing_id:
-                self.refresh()
-                await asyncio.sleep(delay)
+                latency = await self.request_refresh()
+                await asyncio.sleep(self.next_delay(delay, latency))
         except:
             self.refresh_btn.value = False
 
+    max_interval = 60
+    def next_delay(self, delay, latency):
+        """ Back off if the queries are slow, so that they take at most 1/5 of the time """
+        return min(max(delay, 4*latency), self.max_interval)
+
+    _inflight = None
+    _rerun    = False
+    def request_refresh(self, rerun=False):
+        """
+        Refresh in the thread pool without blocking the event loop.
+        Requests during a running refresh are coalesced into it, or into one
+        more refresh after it if `rerun` (e.g. the jobs have been modified).
+        Returns an awaitable of the query latency in seconds.
+        """
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            t0 = time.time()
+            self.refresh()
+            f = loop.create_future()
+            f.set_result(time.time() - t0)
+            return f
+        # Errors are logged by _refresh_bg, and most callers discard the returned future
+        consume = lambda f: f.cancelled() or f.exception()
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._refresh_bg())
+            self._inflight.add_done_callback(consume)
+        elif rerun:
+            self._rerun = True
+        f = asyncio.shield(self._inflight)
+        f.add_done_callback(consume)
+        return f
+
+    async def _refresh_bg(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            self._rerun = False
+            t0 = time.time()
+            try:
+                df, changed = await loop.run_in_executor(executor(), self._fetch)
+                # Only the widget is updated on the event loop
+                self._update(df, changed)
+            except Exception as err:
+                self.log.error('Failed to refresh because of %s', repr(err))
+                raise
+            if not self._rerun:
+                return time.time() - t0
+
+    _fingerprint = None # of the table shown, if known
+    last_diff = None
+    def _fetch(self):
+        """ Query the table and compare it with the one shown, returns (table, TableDiff or True) """
+        df, df0 = self.f(), self.df
+        if not (df.index.is_unique and df0.index.is_unique):
+            return df, not df0.equals(df)
+        return df, diff(df0, df, self._fingerprint)
+
+    def _update(self, df, changed):
+        """ Show `df` if `changed`, which is a TableDiff or a bool """
+        fp = getattr(changed, 'fingerprint', None)
+        if changed or fp is not None:
+            self._fingerprint = fp
+        if changed:
+            self.last_diff = changed
+            self.df = df
+            self.grid_widget.df = humanize(df, self.schema)
+            self.log.debug('Updating %s: %s', type(self), changed)
+        self.updated_at.value = '<i>%s</i> %s' % (datetime.datetime.now(), self.memory_usage())
+
+    _memory = (None, '')
+    def memory_usage(self):
+        """ Memory used by the table shown, e.g. '1.2 MiB' """
+        if self._memory[0] is not self.df:
+            self._memory = (self.df, '%.1f MiB' % (self.df.memory_usage(deep=True).sum() / 2**20))
+        return self._memory[1]
+
     def refresh(self, evt=None):
         try:
-            self.updated_at.value = '<i>%s</i>' % datetime.datetime.now()
-            df0 = self.grid_widget.df
-            df  = self.f()
-            if not df0.equals(df):
-                self.grid_widget.df = df
-                self.log.debug('Updating %s', type(self))
+            self._update(*self._fetch())
         except Exception as err:
             self.log.error('Failed to refresh because of %s', repr(err))
             raise
@@ -110,11 +227,15 @@ class TabView(object):
         """ Callback for applying action on slected rows """
         df = self.grid_widget.get_selected_df()
         idxframe = df.index.to_frame()
-        for i in range(len(df.index)):
-            self.f_act( idxframe.iloc[i,:].to_dict() )
+        self.f_act_batch([ idxframe.iloc[i,:].to_dict() for i in range(len(df.index)) ])
+
+    def f_act_batch(self, row_indices):
+        """ Applying action on many rows (called by self.action) """
+        for row_index in row_indices:
+            self.f_act(row_index)
 
     def f_act(self, row_index):
-        """ Applying action on a row (called by self.action) """
+        """ Applying action on a row (called by self.f_act_batch) """
         raise NotImplementedError("Please override f_act in your subclass")
 
     @property
@@ -143,7 +264,20 @@ class JobView(TabView):
             self.log.error('Failed to apply action %s to job %s :\n\t%s',act, job_desc, err)
         else:
             self.log.info('Successfully %s job %s', act, job_desc)
-        self.refresh()
+        self.request_refresh(rerun=True)
+
+    def f_act_batch(self, job_descs):
+        act = self.act_opt.value
+        try:
+            results = self._condor.job_actions(act, job_descs)
+        except Exception as err:
+            self.log.error('Failed to apply action %s to %d jobs :\n\t%s',act, len(job_descs), err)
+        else:
+            failed = {j:r for j,r in results.items() if r != 'Success'}
+            if failed:
+                self.log.error('Failed to apply action %s to jobs %s', act, failed)
+            self.log.info('Successfully %s %d jobs', act, len(results)-len(failed))
+        self.request_refresh(rerun=True)
 
     @property
     def root_widget(self):
@@ -151,6 +285,99 @@ class JobView(TabView):
         return i.VBox([lHBox([i.HBox(self.act_btn), self.refresh_btn  ]),
                        self.grid_widget,self.updated_at])
 
+class PagedJobView(JobView):
+    """ JobView of a PagedTable, which is sorted and filtered by the schedd """
+    grid_options = dict(TabView.grid_options, sortable=False, filterable=False)
+    def __init__(self, f, cdr, **argv):
+        super().__init__(f, cdr, **argv)
+        i=ipywidgets
+        self.prev_btn = i.Button(icon='chevron-left', layout={'width':'40px'})
+        self.prev_btn.on_click(lambda btn: self.goto(self.f.page-1))
+        self.next_btn = i.Button(icon='chevron-right', layout={'width':'40px'})
+        self.next_btn.on_click(lambda btn: self.goto(self.f.page+1))
+        self.page_info = i.HTML()
+
+        self.filter_txt = i.Text(description='Filter', continuous_update=False,
+                                 placeholder='ClassAd expression, e.g. JobStatus==5')
+        self.filter_txt.observe(self.set_filter, 'value')
+        self.sort_opt = i.Dropdown(options=('',)+self.f.plan.attrs, description='Sort by')
+        self.sort_opt.observe(self.set_sort, 'value')
+        self.desc_btn = i.ToggleButton(value=False, icon='sort-amount-desc', tooltip='Descending',
+                                       layout={'width':'40px'})
+        self.desc_btn.observe(self.set_sort, 'value')
+        self._update_page_info()
+
+    def goto(self, page):
+        self.f.page = max(0, min(page, self.f.pages-1))
+        df = self.f.cached_page()
+        if df is not None:
+            self._update(df, True)
+        self.request_refresh(rerun=True)
+
+    def set_filter(self, evt):
+        self.f.filter = self.filter_txt.value.strip()
+        self.goto(0)
+
+    def set_sort(self, evt):
+        self.f.sort_by   = self.sort_opt.value or None
+        self.f.ascending = not self.desc_btn.value
+        self.goto(0)
+
+    def _update(self, df, changed):
+        super()._update(df, changed)
+        self._update_page_info()
+
+    def _update_page_info(self):
+        f = self.f
+        first = f.page*f.page_size
+        self.page_info.value = '%d-%d of %d' % (min(first+1, f.total), min(first+f.page_size, f.total), f.total)
+
+    @property
+    def root_widget(self):
+        i=ipywidgets
+        return i.VBox([lHBox([i.HBox(self.act_btn), self.refresh_btn  ]),
+                       lHBox([self.filter_txt, self.sort_opt, self.desc_btn]),
+                       self.grid_widget,
+                       lHBox([self.updated_at, self.prev_btn, self.page_info, self.next_btn])])
+
+class HistoryView(TabView):
+    """ TabView of a HistoryTable, which is streamed from the schedd in the background """
+    def __init__(self, f, **argv):
+        super().__init__(f, **argv)
+        i=ipywidgets
+        self.constraint_txt = i.Text(value=f.constraint, description='Constraint', continuous_update=False,
+                                     placeholder='ClassAd expression, e.g. Owner=="me"')
+        self.match_opt = i.IntText(f.match, description='Max. jobs', layout={'width':'200px'})
+        self.load_btn = i.Button(description='Load', icon='history')
+        self.load_btn.on_click(self.load)
+        self.progress = i.HTML()
+
+    def load(self, btn=None):
+        self.f.constraint = self.constraint_txt.value.strip()
+        self.f.match      = self.match_opt.value
+        self.progress.value = '<i>Loading...</i>'
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            return self.f.load(self._show)
+        show = lambda df, n, done: loop.call_soon_threadsafe(self._show, df, n, done)
+        fut = loop.run_in_executor(executor(), self.f.load, show)
+        fut.add_done_callback(self._loaded)
+        return fut
+
+    def _loaded(self, fut):
+        if fut.exception():
+            self.progress.value = ''
+            self.log.error('Failed to load the job history because of %s', repr(fut.exception()))
+
+    def _show(self, df, n, done):
+        self._update(df, True)
+        self.progress.value = '%d jobs' % n if done else '<i>%d jobs, loading...</i>' % n
+
+    @property
+    def root_widget(self):
+        i=ipywidgets
+        return i.VBox([lHBox([self.constraint_txt, self.match_opt, self.load_btn, self.progress]),
+                       self.grid_widget, self.updated_at])
 
 class IpyclusterView(TabView):
     def __init__(self, f, cdr, **argv):
@@ -158,9 +385,13 @@ class IpyclusterView(TabView):
         self._condor = cdr
 
         self.exec_host_opt = ipywidgets.Dropdown(
-                options=tuple(set(m['Machine'] for m in cdr.machines())),
-                description='Remote host', disabled=False,
+                description='Remote host', disabled=True,
             )
+        # Whether the user chose '(any)', as the dropdown also selects it when its options change
+        self._any_chosen, self._setting_hosts = False, False
+        self.exec_host_opt.observe(self._host_chosen, 'value')
+        self.set_hosts(cdr.hosts.hosts)
+        self.load_hosts()
         self.profile_opt = ipywidgets.Dropdown(
                 options=self.list_profiles(),
                 description='Profile', disabled=False,
@@ -174,9 +405,55 @@ class IpyclusterView(TabView):
         self.stop_btn = ipywidgets.Button( description='Stop' )
         self.stop_btn.on_click(self.stop)
 
+        self.timing = ipywidgets.HTML(description='Launch')
+
+        self.add_btn = ipywidgets.Button( description='Add', tooltip='Add engines to a cluster on (any) host' )
+        self.add_btn.on_click(lambda btn: self.scale(self.n_opt.value))
+        self.remove_btn = ipywidgets.Button( description='Remove', tooltip='Remove engines of a cluster on (any) host' )
+        self.remove_btn.on_click(lambda btn: self.scale(-self.n_opt.value))
+
     def f_act(self, row_index):
         pass
 
+    def load_hosts(self):
+        """ Load the host inventory in the background, and update the options when it is loaded """
+        f = self._condor.hosts()
+        if f.done():
+            self._hosts_loaded(f)
+        else:
+            f.add_done_callback(self._hosts_loaded)
+
+    def _hosts_loaded(self, f):
+        if f.exception():
+            self.log.error('Failed to list the execute hosts because of %s', repr(f.exception()))
+        else:
+            self.set_hosts(f.result())
+
+    def _host_chosen(self, change):
+        if not self._setting_hosts:
+            self._any_chosen = change['new'] == ''
+
+    def set_hosts(self, hosts):
+        """ Options of the remote hosts from a list of (Machine, free CPUs, free memory) """
+        selected = self.exec_host_opt.value
+        self._setting_hosts = True
+        try:
+            # '(any)' is last, so that the default is a single host and not elastic engines
+            self.exec_host_opt.options = [('{0} ({1} CPUs free)'.format(h, c), h) for h, c, _ in hosts] + [('(any)', '')]
+            if selected in (h for h, _, _ in hosts):
+                self.exec_host_opt.value = selected
+            elif self._any_chosen:
+                self.exec_host_opt.value = ''
+            elif hosts:
+                # The host with most free CPUs, as the options do not select one on ipywidgets 8
+                self.exec_host_opt.value = hosts[0][0]
+            else:
+                # No host yet, rather than the '(any)' selected by ipywidgets 7
+                self.exec_host_opt.value = None
+        finally:
+            self._setting_hosts = False
+        self.exec_host_opt.disabled = False
+
     def start(self, btn):
         try:
             self._condor.start_ipcluster(self.profile_opt.value, self.n_opt.value, self.exec_host_opt.value)
@@ -189,6 +466,21 @@ class IpyclusterView(TabView):
         except (KeyError, RuntimeError) as err:
             self.log.error('Failed to shutdown the cluster because %s', err)
 
+    def _update(self, df, changed):
+        super()._update(df, changed)
+        if not hasattr(self, 'timing'):
+            return # during __init__
+        latency = self._condor.ipycluster_metrics(self.profile_opt.value).get('latency', {})
+        self.timing.value = ' &rarr; '.join('%s <b>+%.1fs</b>' % x for x in latency.items())
+        if self._condor.hosts.stale():
+            self.load_hosts()
+
+    def scale(self, n):
+        try:
+            self._condor.scale_ipcluster(self.profile_opt.value, n)
+        except Exception as err:
+            self.log.error('Failed to scale the cluster of profile=%s because %s', self.profile_opt.value, err)
+
     def list_profiles(self):
         try:
             from IPython.paths import get_ipython_dir
@@ -202,7 +494,8 @@ class IpyclusterView(TabView):
     def root_widget(self):
         i=ipywidgets
         return i.VBox([lHBox( [ self.profile_opt, self.exec_host_opt,self.n_opt, self.refresh_btn]  ),
-                       lHBox([self.act_btn, self.stop_btn]), self.grid_widget, self.updated_at])
+                       lHBox([self.act_btn, self.stop_btn, self.add_btn, self.remove_btn]), self.timing,
+                       self.grid_widget, self.updated_at])
 
 class TabPannel(object):
     _table_layout = tuple()
@@ -232,44 +525,202 @@ class TabPannel(object):
         display(ipywidgets.VBox([c, self.log_stack]))
 
 class Condor(TabPannel):
-    def __init__(self, schedd_name=None):
+    # Seconds for which query results are shared by the tabs
+    query_ttl = 1
+    # Seconds to wait for each schedd when querying many of them
+    schedd_timeout = 10
+    # Seconds to keep the list of execute hosts
+    host_ttl = 300
+    # Column types of the tables, see ClassAdParser.apply_schema
+    job_schema = {'ScheddName':'category', 'ClusterID':'int32', 'ProcID':'int32', 'Owner':'category',
+                  'JobStatus':'category', 'JobUniverse':'category', 'RemoteHost':'category',
+                  'ExitCode':'float32', 'ipengine_n':'float32', 'ImageSize':Bytes(1024),
+                  'DiskUsage':Bytes(1024), 'RequestDisk':Bytes(1024), 'RequestMemory':Bytes(2**20),
+                  'MemoryUsage':Bytes(2**20)}
+    machine_schema = {'Machine':'category', 'SlotID':'category', 'State':'category', 'Activity':'category',
+                      'CPUs':'int32', 'TotalSlots':'int32', 'TotalCPUs':'int32', 'TotalLoadAvg':'float32',
+                      'Memory':Bytes(2**20), 'TotalMemory':Bytes(2**20), 'Disk':Bytes(1024),
+                      'TotalDisk':Bytes(1024)}
+    # Directory of the table snapshots from which new dashboards start, None to disable
+    snapshot_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'ipycondor')
+    def __init__(self, schedd_name=None, schedds=None):
+        """
+        schedd_name: name of the schedd, the local one by default
+        schedds:     'all' or a list of schedd names, whose jobs are merged
+                     into the job tables with a `ScheddName` column
+        """
         super().__init__()
+        self.cache = QueryCache(ttl=self.query_ttl)
         self.coll = htcondor.Collector()
-        # schedd_names =  [ s['Name'] for s in coll.locateAll(htcondor.DaemonTypes.Schedd)]
-        if schedd_name:
-            schedd_ad = self.coll.locate(htcondor.DaemonTypes.Schedd, schedd_name)
+        self.hosts = HostInventory(self.machines, executor, ttl=self.host_ttl)
+        self.snapshots = SnapshotStore(self.snapshot_dir) if self.snapshot_dir else None
+        if schedds == 'all':
+            schedd_ads = self.coll.locateAll(htcondor.DaemonTypes.Schedd)
+        elif schedds:
+            schedd_ads = [self.coll.locate(htcondor.DaemonTypes.Schedd, n) for n in schedds]
+        elif schedd_name:
+            schedd_ads = [self.coll.locate(htcondor.DaemonTypes.Schedd, schedd_name)]
         else:
-            schedd_ad = self.coll.locate(htcondor.DaemonTypes.Schedd)
-        self.schedd = htcondor.Schedd(schedd_ad)
+            schedd_ads = [self.coll.locate(htcondor.DaemonTypes.Schedd)]
+        self.schedds = OrderedDict((ad['Name'], htcondor.Schedd(ad)) for ad in schedd_ads)
+        self.schedd  = next(iter(self.schedds.values()))
+        self._fanout  = None
+        self._pending = {} # schedd name -> {query: (future, submit time)}
+        self._pending_lock = threading.Lock()
         self._table_layout = [("Jobs", self.job_table),
             ("Machines", self.machine_table),
+            ("Summary", self.summary_table),
+            ("History", self.history_table),
             ("IPyCluster", self.ipycluster_table)]
         self.my_job_id = my_job_id()
         self.ipyclusters = {}
 
-    def jobs(self, constraint=''):
-        return self.schedd.query(constraint.encode())
-
-    def machines(self, constraint=''):
+    @property
+    def multi_schedd(self):
+        return len(self.schedds) > 1
+
+    def jobs(self, constraint='', projection=(), limit=-1):
+        if not self.multi_schedd:
+            return self._query_schedd(None, self.schedd, constraint, projection, limit)
+        # Query all schedds concurrently, skipping those slower than schedd_timeout.
+        # A query in flight is shared by the callers, and a schedd which has not
+        # answered for schedd_timeout gets no more queries until it does.
+        key, now = (constraint, tuple(projection), limit), time.time()
+        futures = OrderedDict()
+        with self._pending_lock:
+            if self._fanout is None:
+                self._fanout = ThreadPoolExecutor(max_workers=4*len(self.schedds), thread_name_prefix='ipycondor-schedd')
+            for name, s in self.schedds.items():
+                pending = self._pending.setdefault(name, {})
+                for k, (f, t) in tuple(pending.items()):
+                    if f.done():
+                        del pending[k]
+                if any(now > t + self.schedd_timeout for f, t in pending.values()):
+                    self.log.warning('Skipping schedd %s, which has not answered for %ss', name, self.schedd_timeout)
+                    continue
+                if key not in pending:
+                    pending[key] = (self._fanout.submit(self._query_schedd, name, s, constraint, projection, limit), now)
+                futures[name] = pending[key][0]
+        wait(futures.values(), timeout=self.schedd_timeout)
+        ads = []
+        for name, f in futures.items():
+            if not f.done():
+                self.log.warning('Schedd %s did not answer within %ss', name, self.schedd_timeout)
+                continue
+            try:
+                ads.extend(f.result())
+            except Exception as err:
+                self.log.warning('Failed to query schedd %s: %s', name, err)
+        return ads
+
+    def _query_schedd(self, name, schedd, constraint, projection, limit=-1):
+        constraint = _bind_schedd_name(constraint, name)
+        if limit >= 0:
+            # Limited queries are for pages of a table, which are not shared
+            ads = schedd.query(constraint.encode(), list(projection), limit=limit)
+        else:
+            ads = self.cache.get(name or 'schedd', constraint, projection,
+                lambda: schedd.query(constraint.encode(), list(projection)),
+                timeout=None if name is None else self.schedd_timeout)
+        if name is not None:
+            for j in ads:
+                j['ScheddName'] = name
+        return ads
+
+    def machines(self, constraint='', projection=()):
         constraint = 'MyType=="Machine"&&({0})'.format(constraint) if constraint else 'MyType=="Machine"'
-        return self.coll.query(constraint=constraint.encode())
+        return self.cache.get('collector', constraint, projection,
+            lambda: self.coll.query(constraint=constraint.encode(), projection=list(projection)))
+
+    def history(self, constraint='', projection=(), match=-1):
+        """ Iterator of the job ads in the history of the schedds, newest first per schedd """
+        for name, schedd in self.schedds.items():
+            name = name if self.multi_schedd else None
+            for j in schedd.history(_bind_schedd_name(constraint, name) or 'true', list(projection), match=match):
+                if name is not None:
+                    j['ScheddName'] = name
+                yield j
+
+    def _route(self, job_argv):
+        """ The schedd owning a job, and the job attributes without `ScheddName` """
+        job_argv = dict(job_argv)
+        name = job_argv.pop('ScheddName', None)
+        return self.schedds[name] if name else self.schedd, job_argv
 
     def job_action(self, act,  job_argv):
-        if self.my_job_id and self.my_job_id == job_argv.get('ClusterID'):
-            raise ValueError("This notebook is running in a condor job, which cannot kill itself!")
-        et = ExprTree('True')
-        for k,v in job_argv.items():
-            et = et.and_( ExprTree(k) == v )
-        act_args = str(et)
-        res = self.schedd.act( getattr(htcondor.JobAction, act), act_args )
+        self._check_self_kill([job_argv])
+        schedd, job_argv = self._route(job_argv)
+        act_args = _job_expr(job_argv)
+        res = schedd.act( getattr(htcondor.JobAction, act), act_args )
+        self.cache.clear()
         if not res['TotalSuccess'] > 0:
             trimedres = {k:res[k] for k in res if res[k]>0}
             raise RuntimeError("Action %s with constraint %s failed with error:%s"%(act, act_args, trimedres))
         self.log.info("The job [%s] has been %sed", job_argv, act )
         return res
 
+    def job_actions(self, act, job_argvs):
+        """
+        Apply an action to many jobs in a single `schedd.act` call
+
+        :param act: name of the htcondor.JobAction
+        :param job_argvs: list of job attributes, e.g. [{'ClusterID':1, 'ProcID':0}, ...]
+        :rtype: dict of the result of each job, e.g. {'1.0':'Success'}
+        """
+        job_argvs = list(job_argvs)
+        if not job_argvs:
+            return {}
+        self._check_self_kill(job_argvs)
+        # One call per schedd owning the jobs
+        by_schedd = OrderedDict()
+        for j in job_argvs:
+            name = j.get('ScheddName', None)
+            by_schedd.setdefault(name, []).append(self._route(j)[1])
+        results = {}
+        for name, argvs in by_schedd.items():
+            schedd = self.schedds[name] if name else self.schedd
+            prefix = name+'/' if name else ''
+            for k, r in self._act(schedd, act, argvs).items():
+                results[prefix+k] = r
+        self.cache.clear()
+        return results
+
+    def _act(self, schedd, act, job_argvs):
+        ids = [_job_id(j) for j in job_argvs]
+        if all(ids):
+            res = schedd.act( getattr(htcondor.JobAction, act), ids )
+            results = {i:'Success' for i in ids}
+            if res['TotalSuccess'] < len(ids):
+                # The result has only the totals, find the failed jobs from their status
+                results.update(self._check_applied(schedd, act, ids))
+        else:
+            # Without job IDs only the total results are available
+            act_args = '||'.join('(%s)' % _job_expr(j) for j in job_argvs)
+            res = schedd.act( getattr(htcondor.JobAction, act), act_args )
+            results = {act_args: 'Success' if res['TotalSuccess'] > 0 else 'Error'}
+        self.log.debug("Action %s on %d jobs: %s", act, len(job_argvs), dict(res))
+        return results
+
+    @staticmethod
+    def _check_applied(schedd, act, ids):
+        """ 'Success', 'NotFound' or 'Error' of `act` on each job of `ids` """
+        expr = '||'.join('(ClusterId==%s&&ProcId==%s)' % tuple(i.split('.')) for i in ids)
+        status = {'%d.%d' % (j['ClusterId'], j['ProcId']):j.get('JobStatus', None)
+                  for j in schedd.query(expr, ['ClusterId', 'ProcId', 'JobStatus'])}
+        applied = ACTION_APPLIED.get(act, lambda st: False)
+        return {i:'Success' if applied(status.get(i, None)) else
+                  'NotFound' if i not in status else 'Error' for i in ids}
+
+    def _check_self_kill(self, job_argvs):
+        if self.my_job_id and any(self.my_job_id == j.get('ClusterID') for j in job_argvs):
+            raise ValueError("This notebook is running in a condor job, which cannot kill itself!")
+
     def start_ipcluster(self, profile, n, exec_host):
         # Mimic: https://github.com/ipython/ipyparallel/blob/master/ipyparallel/nbextension/clustermanager.py
+        from .ipcluster import NbIPClusterStart
+        if exec_host is None:
+            self.log.error('No remote host is chosen for the cluster of profile %s', profile)
+            return
         clusters = self.ipyclusters
         starter  = clusters.get(profile,None)
         if isinstance(starter, NbIPClusterStart):
@@ -283,100 +734,184 @@ class Condor(TabPannel):
         self.log.info('Profile is loaded from %s with cluster-id=%s',
                        starter.profile_dir.location, starter.cluster_id)
 
-        starter.engine_launcher.requirements = 'requirements = ( Machine == "%s" )' % exec_host
+        if exec_host:
+            starter.engine_launcher.requirements = 'requirements = ( Machine == "%s" )' % exec_host
+        elif hasattr(starter.engine_launcher, 'elastic'):
+            # '(any)': engines spread over the pool
+            starter.engine_launcher.elastic = True
         starter.start(int(n))
 
+    def ipycluster_metrics(self, profile):
+        """ Timestamps and latencies of the launch stages of the cluster of `profile`, see NbIPClusterStart.metrics """
+        starter = self.ipyclusters.get(profile, None)
+        return starter.metrics() if starter is not None else {}
+
+    def scale_ipcluster(self, profile, n):
+        """ Add `n` engines to the elastic cluster of `profile`, or remove -`n` engines """
+        launcher = self.ipyclusters[profile].engine_launcher
+        if not getattr(launcher, 'elastic', False):
+            raise RuntimeError('The engines of profile %s are not elastic' % profile)
+        if n > 0:
+            launcher.add_engines(n)
+        elif n < 0:
+            launcher.remove_engines(-n)
+
+    def _snapshot(self, f, daemon, constraint, columns, index, schema):
+        if self.snapshots is None:
+            return f
+        key = self.snapshots.key(daemon, constraint, tuple(columns), tuple(index), sorted(schema.items()))
+        return SnapshotTable(f, self.snapshots, key, index)
+
     @staticmethod
-    def _wrap_tab_hdl(classAds_hdl, constraint, cols, key_cols = tuple() ):
+    def _wrap_tab_hdl(classAds_hdl, constraint, cols, key_cols = tuple(), incremental=False, follow_logs=False,
+                      schema=None):
         columns = tuple(key_cols) + tuple(c for c in cols if c not in key_cols)
+        if follow_logs:
+            from .events import EventLogTable
+            return EventLogTable(classAds_hdl, constraint, columns, key_cols, schema=schema)
+        if incremental:
+            return IncrementalTable(classAds_hdl, constraint, columns, key_cols, schema=schema)
+        # Only fetch the attributes shown in the table and those read by the parser rules
+        plan = QueryParser().compile(columns, schema)
         # Create QGrid table widget
         def getdf():
-            indx = key_cols
-            df = pd.DataFrame(deep_parse(classAds_hdl(constraint), columns), columns=columns)
-            if len(df)==0:
-                indx = [indx[0],]
-            if indx:
-                df.set_index(list(indx),inplace=True)
-                df.sort_index(inplace=True)
-            return df
+            return indexed(plan.to_frame(classAds_hdl(constraint, plan.attrs)), key_cols)
         return getdf
 
     def job_table(self, constraint='',
              columns = ('ClusterID','ProcID','Owner','JobStatus','JobDescription',
                       'JobStartDate','JobUniverse', 'RemoteHost'),
-             index = ('ClusterID','ProcID')):
-        return JobView(self._wrap_tab_hdl(self.jobs,constraint, columns, index), self, log=self.log).root_widget
+             index = ('ClusterID','ProcID'), incremental=False, follow_logs=False, page_size=None):
+        """
+        incremental: only fetch the jobs changed since the last refresh
+        follow_logs: update the table from the job event logs, and reconcile
+                     it with the schedd in the background
+        page_size:   show the queue in pages of `page_size` jobs, for which only
+                     the visible jobs are fetched
+        """
+        if self.multi_schedd:
+            if follow_logs:
+                raise ValueError('follow_logs is not supported for multiple schedds')
+            index = ('ScheddName',) + tuple(index)
+        if page_size:
+            columns = tuple(index) + tuple(c for c in columns if c not in index)
+            return PagedJobView(PagedTable(self.jobs, constraint, columns, index, page_size, schema=self.job_schema),
+                                self, log=self.log, schema=self.job_schema).root_widget
+        f = self._wrap_tab_hdl(self.jobs,constraint, columns, index, incremental, follow_logs, self.job_schema)
+        f = self._snapshot(f, tuple(self.schedds), constraint, columns, index, self.job_schema)
+        return JobView(f, self, log=self.log, interval=0.5 if follow_logs else 2, schema=self.job_schema).root_widget
+
+    def history_table(self, constraint='',
+             columns = ('ClusterID','ProcID','Owner','JobStatus','QDate','CompletionDate',
+                      'ExitCode','RemoteHost'),
+             index = ('ClusterID','ProcID'), match=10000):
+        """
+        Jobs which have left the queue, loaded with the Load button.
+        match: maximum number of jobs to load, -1 for the whole history
+        """
+        if self.multi_schedd:
+            index = ('ScheddName',) + tuple(index)
+        columns = tuple(index) + tuple(c for c in columns if c not in index)
+        return HistoryView(HistoryTable(self.history, constraint, columns, index, match, schema=self.job_schema),
+                           log=self.log, schema=self.job_schema).root_widget
 
     def slot_table(self, constraint='',
              columns = ('Machine','SlotID','Activity','CPUs','Memory'),
              index = ('Machine','SlotID')):
-        return TabView(self._wrap_tab_hdl(self.machines,constraint, columns, index), log=self.log).root_widget
+        f = self._wrap_tab_hdl(self.machines,constraint, columns, index, schema=self.machine_schema)
+        f = self._snapshot(f, 'collector', constraint, columns, index, self.machine_schema)
+        return TabView(f, log=self.log, schema=self.machine_schema).root_widget
 
 
     def machine_table(self,constraint='SlotID==1||SlotID=="1_1"',
             columns = ('Machine','TotalSlots','TotalCPUs','TotalMemory',
                      'TotalDisk','TotalLoadAvg'),
             index = ('Machine',)):
-        return TabView(self._wrap_tab_hdl(self.machines,constraint, columns, index), log=self.log).root_widget
+        f = self._wrap_tab_hdl(self.machines,constraint, columns, index, schema=self.machine_schema)
+        f = self._snapshot(f, 'collector', constraint, columns, index, self.machine_schema)
+        return TabView(f, log=self.log, schema=self.machine_schema).root_widget
+
+    def summary_table(self, constraint='', slot_constraint=''):
+        """
+        constraint:      of the jobs
+        slot_constraint: of the slots in the machine usage
+        """
+        from . import summary as S
+        jobs  = lambda: S.job_frame(self.jobs(constraint, QueryParser.projection(S.JOB_ATTRS) + ['RemoteHost']))
+        slots = lambda: S.raw_frame(self.machines(slot_constraint, S.SLOT_ATTRS), S.SLOT_ATTRS)
+        views = [("Jobs by owner", lambda: S.by_owner_status(jobs())),
+                 ("Jobs by universe", lambda: S.by_universe(jobs())),
+                 ("Running jobs by machine", lambda: S.by_machine(jobs())),
+                 ("Machine usage", lambda: S.machine_usage(slots()))]
+        acc = ipywidgets.Accordion(children=[TabView(f, log=self.log).root_widget for t, f in views])
+        for i, (t, f) in enumerate(views):
+            acc.set_title(i, t)
+        return acc
 
     def ipycluster_table(self, constraint='ipengine_n > 0',
              columns = ('ClusterID','ProcID','Owner','JobStatus',
                       'JobStartDate','ipengine_n', 'RemoteHost'),
-             index = ('ClusterID','ProcID')):
-        return IpyclusterView(self._wrap_tab_hdl(self.jobs,constraint, columns, index), self, log=self.log).root_widget
-
-@magics_class
-class CondorMagics(Magics):
-    _condor = None
-    @cell_magic
-    def CondorJob(self, line, cell): #pylint: disable=R0201
-        "Creation of a condor job"
-        # username = os.environ.get('JUPYTERHUB_USER', os.environ.get('USER'))
-        p = Popen( [ 'condor_submit' ] , stdin=PIPE,stdout=PIPE, stderr=PIPE)
-        out,err = p.communicate(cell.encode('utf-8'))
-        out=out.decode('utf-8','replace')
-        err=err.decode('utf-8','replace')
-        logger.info('[%d]: %s \n\t%s', p.poll(), out, err)
-
-    @line_magic
-    def CondorMon(self,line):
-        "Display the Condor dashboard"
-        return self.condor.dashboard()
-
-    @property
-    def condor(self):
-        c = getattr(self,'_condor', None)
-        if not isinstance(c, Condor):
-            c = Condor()
-            self._condor = c
-        return c
-
+             index = ('ClusterID','ProcID'), incremental=False):
+        if self.multi_schedd:
+            index = ('ScheddName',) + tuple(index)
+        return IpyclusterView(self._wrap_tab_hdl(self.jobs,constraint, columns, index, incremental, schema=self.job_schema),
+                              self, log=self.log, schema=self.job_schema).root_widget
 
 class LogHandler(logging.Handler):
     expireIn=15
+    # Size of the ring buffer of records
+    maxlen=200
+    # Minimal interval between two updates of the widget in seconds
+    debounce=0.3
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.log_stack = ipywidgets.Output(layout  = { 'width': '95%', 'max-height': '160px'})
         self.clear_btn = ipywidgets.Button(description='Clear' , layout={'display':'none'})
         self.clear_btn.on_click(self.clear_all)
-        self.records = []
+        self.records = deque(maxlen=self.maxlen)
+        self.dropped = 0
+        self._loop = asyncio.get_event_loop()
+        self._push_pending = False
+        self._last_push = 0
 
     def emit(self, record):
-        ctime = record.created
-        self.records.insert(0, (ctime, self.format(record)))
-        now = time.time()
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.appendleft((record.created, self.format(record)))
+        if not self._loop.is_running():
+            self.push()
+        elif not self._push_pending:
+            self._push_pending = True
+            # emit may be called from the threads of background queries
+            self._loop.call_soon_threadsafe(self._schedule_push)
+
+    def _schedule_push(self):
+        delay = self._last_push + self.debounce - time.time()
+        self._loop.call_later(max(delay, 0), self.push)
+
+    def push(self):
+        """ Push the unexpired records to the widget """
+        self._push_pending = False
+        self._last_push = now = time.time()
+        records = self.records
+        while records and now - records[-1][0] >= self.expireIn:
+            records.pop()
         outputs = tuple({
                 'name': 'stdout',
                 'output_type': 'stream',
                 'text': r+'\n'
-            } for c, r in self.records if now - c < self.expireIn
+            } for c, r in tuple(records)
         )
+        if outputs and self.dropped:
+            outputs += ({'name': 'stdout', 'output_type': 'stream',
+                         'text': '... %d earlier records dropped\n' % self.dropped},)
         self.clear_btn.layout.display = 'block' if outputs else 'none'
         self.log_stack.outputs = outputs
 
     def clear_all(self, *args):
-        self.records = []
+        self.records.clear()
+        self.dropped = 0
         self.log_stack.clear_output()
         self.clear_btn.layout.display = 'none'
 
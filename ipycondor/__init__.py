@@ -1,6 +1,13 @@
 # Copyright 2019 Mingxuan Lin
 
-from .Condor import CondorMagics, Condor
+# The dashboard and its dependencies (htcondor, ipywidgets, pandas, ...)
+# are only imported when `Condor` is first used
+from .magics import CondorMagics, load_ipython_extension, bind_condor
+
+def __getattr__(name):
+    if name == 'Condor':
+        return bind_condor()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 try:
     ip = get_ipython()
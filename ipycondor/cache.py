@@ -0,0 +1,150 @@
+# Copyright 2019 Mingxuan Lin
+" Cache of the query results shared by the tabs of a dashboard "
+import time, threading, asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class QueryCache(object):
+    """
+    TTL cache of query results keyed by (daemon, constraint, projection)
+
+    A result also serves the queries of a subset of its projection
+    (an empty projection stands for all attributes). Concurrent callers of
+    the same query wait for the request in flight instead of issuing a
+    duplicate one.
+
+    Usage:
+        cache = QueryCache(ttl=1, maxsize=32)
+        ads = cache.get('schedd', 'Owner=="me"', ['ClusterId'], lambda: schedd.query(...))
+        cache.stats()
+    """
+    def __init__(self, ttl=1, maxsize=32):
+        self.ttl     = ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = self.waits = 0
+        self._entries = OrderedDict() # key -> [expiry, future]
+        self._lock    = threading.Lock()
+
+    @staticmethod
+    def _covers(proj, other):
+        return not proj or (other and proj.issuperset(other))
+
+    def _lookup(self, daemon, constraint, proj):
+        key = (daemon, constraint, proj)
+        if key in self._entries:
+            yield key
+        for k in self._entries:
+            if k[:2] == key[:2] and k != key and self._covers(k[2], proj):
+                yield k
+
+    def get(self, daemon, constraint, projection, query, timeout=None):
+        """
+        Result of `query()`, which queries `daemon` with `constraint` and `projection`.
+        Waiting for the same query in flight raises concurrent.futures.TimeoutError
+        after `timeout` seconds.
+        """
+        proj = frozenset(a.lower() for a in projection)
+        now  = time.time()
+        with self._lock:
+            # Drop the expired results, the constraints of incremental queries change on each call
+            for k in [k for k, (expiry, _) in self._entries.items() if expiry <= now]:
+                del self._entries[k]
+            for k in self._lookup(daemon, constraint, proj):
+                fut = self._entries[k][1]
+                if not fut.done():
+                    self.waits += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(k)
+                break
+            else:
+                fut = None
+                self.misses += 1
+                entry = self._entries[(daemon, constraint, proj)] = [float('inf'), Future()]
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        if fut is not None:
+            return fut.result(timeout)
+
+        try:
+            res = query()
+        except BaseException as err:
+            with self._lock:
+                self._pop(daemon, constraint, proj, entry)
+            entry[1].set_exception(err)
+            raise
+        entry[0] = time.time() + self.ttl
+        entry[1].set_result(res)
+        return res
+
+    def _pop(self, daemon, constraint, proj, entry):
+        if self._entries.get((daemon, constraint, proj), None) is entry:
+            del self._entries[(daemon, constraint, proj)]
+
+    def clear(self):
+        """ Invalidate all cached results, e.g. after modifying jobs """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'waits':self.waits, 'size':len(self._entries)}
+
+class HostInventory(object):
+    """
+    Execute hosts of the pool ranked by their unclaimed CPUs and memory
+
+    Only the attributes `attrs` of the slot ads are queried, and the result is
+    kept for `ttl` seconds. Calling the inventory returns an awaitable of the
+    list of (Machine, free CPUs, free memory in MB), which is loaded in the
+    thread pool `executor()` while the event loop is running.
+
+    Usage:
+        hosts = HostInventory(condor.machines, executor, ttl=300)
+        if hosts.stale():
+            hosts().add_done_callback(lambda f: print(f.result()))
+    """
+    attrs = ('Machine', 'State', 'Cpus', 'Memory')
+    def __init__(self, query, executor, ttl=300):
+        self.query    = query # query(constraint, projection)
+        self.executor = executor
+        self.ttl      = ttl
+        self.hosts    = []
+        self.expiry   = 0
+        self._inflight = None
+
+    @staticmethod
+    def rank(slots):
+        free = OrderedDict()
+        for m in slots:
+            h = m.get('Machine', None)
+            if not h:
+                continue
+            cpus, mem = free.get(h, (0, 0))
+            if m.get('State', '') == 'Unclaimed':
+                cpus += m.get('Cpus', 0)
+                mem  += m.get('Memory', 0)
+            free[h] = (cpus, mem)
+        return sorted(((h,)+v for h, v in free.items()), key=lambda x: (-x[1], -x[2], x[0]))
+
+    def load(self):
+        self.hosts  = self.rank(self.query('', self.attrs))
+        self.expiry = time.time() + self.ttl
+        return self.hosts
+
+    def stale(self):
+        """ Whether the hosts have expired and are not being loaded """
+        return time.time() >= self.expiry and (self._inflight is None or self._inflight.done())
+
+    def __call__(self):
+        loop = asyncio.get_event_loop()
+        if self._inflight is not None and not self._inflight.done():
+            return self._inflight
+        if time.time() < self.expiry or not loop.is_running():
+            f = loop.create_future()
+            try:
+                f.set_result(self.hosts if time.time() < self.expiry else self.load())
+            except Exception as err:
+                f.set_exception(err)
+            return f
+        self._inflight = loop.run_in_executor(self.executor(), self.load)
+        return self._inflight
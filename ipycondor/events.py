@@ -0,0 +1,119 @@
+# Copyright 2019 Mingxuan Lin
+" Job table updates driven by HTCondor job event logs "
+import os, time, logging
+
+import htcondor
+
+from .tables import IncrementalTable, upsert
+
+logger = logging.getLogger(__name__)
+
+_T = htcondor.JobEventType
+# JobStatus of a job after an event
+EVENT_STATUS = {_T.SUBMIT:1, _T.EXECUTE:2, _T.JOB_HELD:5, _T.JOB_RELEASED:1,
+                _T.JOB_EVICTED:1, _T.JOB_SUSPENDED:7, _T.JOB_UNSUSPENDED:2}
+# Events after which a job leaves the queue
+EVENT_LEAVE  = {_T.JOB_TERMINATED, _T.JOB_ABORTED}
+
+class EventLogTail(object):
+    """ Read the new events of a set of job event logs without blocking """
+    def __init__(self):
+        self.logs = {}
+
+    def follow(self, paths):
+        """ Start tailing the logs in `paths` from their current ends """
+        for p in paths:
+            if p in self.logs or not os.access(p, os.R_OK):
+                continue
+            try:
+                jel = htcondor.JobEventLog(p)
+                for _ in jel.events(stop_after=0): pass
+            except Exception as err:
+                logger.debug('Cannot follow job event log %s: %s', p, err)
+            else:
+                self.logs[p] = jel
+
+    def events(self):
+        for p, jel in tuple(self.logs.items()):
+            try:
+                for evt in jel.events(stop_after=0):
+                    yield evt
+            except Exception as err:
+                logger.debug('Stop following job event log %s: %s', p, err)
+                self.logs.pop(p).close()
+
+class EventLogTable(IncrementalTable):
+    """
+    Job table updated from the event logs of the jobs
+
+    Submit, execute, hold, release, evict, terminate and abort events are
+    applied directly to the `JobStatus` column of the table (and new jobs are
+    fetched from the schedd). The table is reconciled with the schedd queue
+    every `reconcile_interval` seconds, which also picks up new event logs.
+    The key columns of the table must be ('ClusterID', 'ProcID').
+    """
+    reconcile_interval = 30
+    max_fetch = 500
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tail = EventLogTail()
+        self.last_reconcile = 0
+        self.status_plan = self.parser.compile(('JobStatus',)) if 'JobStatus' in self.plan.columns else None
+
+    def __call__(self):
+        if self.table is None or time.time() > self.last_reconcile + self.reconcile_interval:
+            return self.reconcile()
+        self.apply_events(self.tail.events())
+        return self.current()
+
+    def reconcile(self):
+        df = super().__call__()
+        self.last_reconcile = time.time()
+        self.tail.follow(self.user_logs())
+        return df
+
+    def user_logs(self):
+        paths = set()
+        for j in self.classAds_hdl(self.constraint, ('UserLog', 'Iwd')):
+            p = j.get('UserLog', None)
+            if isinstance(p, str) and p:
+                paths.add(os.path.join(j.get('Iwd', ''), p))
+        return paths
+
+    def apply_events(self, events):
+        """ Apply job events to the table, returns whether the table has changed """
+        status, leave = {}, set()
+        for evt in events:
+            key = (evt.cluster, evt.proc)
+            if evt.type in EVENT_LEAVE:
+                leave.add(key)
+                status.pop(key, None)
+            elif evt.type in EVENT_STATUS:
+                status[key] = EVENT_STATUS[evt.type]
+                leave.discard(key)
+        if not (status or leave):
+            return False
+
+        table = self.table.copy()
+        if leave:
+            table = table[~table.index.isin(list(leave))]
+        new = [k for k in status if k not in table.index]
+        if self.status_plan is not None:
+            for k, v in status.items():
+                if k in table.index:
+                    table.loc[k, 'JobStatus'] = self.status_plan({'JobStatus':v})['JobStatus']
+        self.table = table
+        if len(new) > self.max_fetch:
+            self.update()
+        elif new:
+            self.fetch(new)
+        logger.debug('Applied events of %d jobs', len(status)+len(leave))
+        return True
+
+    def fetch(self, keys):
+        """ Query and insert the jobs of (ClusterId, ProcId) `keys` """
+        expr = '||'.join('(ClusterId=={0}&&ProcId=={1})'.format(*k) for k in keys)
+        ads = self.classAds_hdl(self._where(expr), self.plan.attrs)
+        if len(ads) > 0:
+            self.table = upsert(self.table, self._frame(self.plan, ads))
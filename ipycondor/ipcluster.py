@@ -38,8 +38,10 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import time
+import asyncio
+from traitlets import Instance
 from ipyparallel.apps.ipclusterapp import IPClusterStart
+from .timeline import Timeline
 class NbIPClusterStart(IPClusterStart):
     """
     `ipcluster start` wraper for notebook
@@ -61,10 +63,64 @@ class NbIPClusterStart(IPClusterStart):
             self.stop_controller()
             self.stop_engines()
     def start(self, n=None):
+        """
+        Start the controller, and the engines as soon as the controller is ready.
+        Returns immediately with the future of starting the engines.
+        """
+        self.timeline = Timeline()
+        self.timeline.mark('start')
         if isinstance(n,int):
             self.n = n #pylint: disable=W0201
         if self.controller_launcher.state == 'before':
             self.start_controller()
-            time.sleep(self.delay)
-        if self.engine_launcher.state == 'before':
-            self.start_engines()
+        return asyncio.ensure_future(self.start_engines_when_ready())
+
+    async def start_engines_when_ready(self):
+        wait = getattr(self.engine_launcher, 'wait_for_controller', None)
+        try:
+            if wait is None:
+                await asyncio.sleep(self.delay)
+            elif not await wait():
+                self.log.error('IPython cluster: controller is not ready, stopping')
+                self.stop_launchers()
+                return
+            self.timeline.mark('controller ready')
+            if self.engine_launcher.state == 'before':
+                self.start_engines()
+                asyncio.ensure_future(self.wait_for_engines())
+        except Exception as err:
+            self.log.error('IPython cluster: failed to start engines because %s', err)
+            self.stop_launchers()
+
+    # Stages of a launch in their order, see metrics
+    stages = ('start', 'controller ready', 'job submitted', 'job idle', 'job running',
+              'tunnel established', 'engines registered')
+    registration_timeout = 300
+    timeline = Instance(Timeline, ())
+
+    async def wait_for_engines(self):
+        """ Record the stage 'engines registered' when all engines have registered with the hub """
+        from .launcher import wait_for
+        try:
+            from ipyparallel import Client
+            client = Client(profile_dir=self.profile_dir.location, cluster_id=self.cluster_id)
+        except Exception as err:
+            self.log.debug('IPython cluster: cannot connect to the hub: %s', err)
+            return
+        try:
+            if await wait_for(lambda: len(client.ids) >= self.n, self.registration_timeout, 1):
+                self.timeline.mark('engines registered')
+                self.log.info('IPython cluster: %d engines registered %s', self.n,
+                              ', '.join('%s +%.1fs' % x for x in self.metrics()['latency'].items()))
+        finally:
+            client.close()
+
+    def metrics(self):
+        """
+        Timestamps of the launch stages of the cluster and its engine launcher,
+        and the latency of each stage in seconds since the previous one
+        """
+        stages = dict(self.timeline.stages)
+        stages.update(getattr(self.engine_launcher, 'timeline', Timeline()).stages)
+        return {'timestamps': {s:stages[s] for s in self.stages if s in stages},
+                'latency': self.timeline.latency(self.stages, stages)}
@@ -1,9 +1,12 @@
 # Copyright 2019 Mingxuan Lin
 
-import time, json, os, subprocess, socket, io
+import time, json, os, re, subprocess, socket, io, logging, asyncio
+from collections import deque, OrderedDict
+import htcondor
 from ipyparallel.apps.launcher import HTCondorLauncher, BatchClusterAppMixin, ioloop
 from IPython.utils.process import check_pid
-from traitlets import (Any, Integer, List, Set, Unicode, default)
+from .timeline import Timeline
+from traitlets import (Bool, Dict, Instance, Integer, List, Set, Unicode, default)
 # CFloat,Dict, Instance, HasTraits, CRegExp, TraitError, validate, observe
 
 def prefix (a,b):
@@ -31,6 +34,26 @@ arguments="mpiexec --n {n} ipengine --file={name_pre}-engine.json --cluster-id={
 
 queue
 """ , config=True)
+    elastic_batch_template = Unicode("""
+universe=vanilla
+executable={exec_cmd}
+transfer_executable=true
+transfer_input_files={files_to_send}
+should_transfer_files=yes
+
+arguments="ipengine --file={name_pre}-engine.json --cluster-id={cluster_id} --timeout=30 "
+
++ipengine_n=1
+
+{requirements}
+{environments}
+{x509UserProxy}
+{pipes_str}
+
+queue {n}
+""" , config=True, help="Job description of the elastic mode, one engine per proc")
+    elastic = Bool(False, config=True,
+        help="Submit the engines as procs of a cluster spread over the pool, which can be added and removed")
 
     to_send      = List([], config=True, help="List of local files to send before starting")
     to_pipe      = Set({'error','log'}, config=True, help="[output|error|log]")
@@ -41,7 +64,7 @@ queue
     job_timeout  = Integer(30, help='Timeout for job starting in seconds', config=True)
 
     x509UserProxy = Unicode(prefix('x509UserProxy=', os.environ.get('X509_USER_PROXY')))
-    ssh_to_job_proc = Any()
+    ssh_tunnels = Dict() # job id -> SshTunnel, or None if it has failed
 
     _context_keys = ( 'requirements', 'environments', 'exec_cmd', 'name_pre',
         'files_to_send', 'x509UserProxy', 'pipes_str' )
@@ -72,15 +95,29 @@ queue
     @property
     def pipes_str(self):
         a,b="stream_{0}=true\n", "{0}=ipyengine.$(ClusterId).{0}.txt\n"
-        f=lambda x: (a+b) if x in {'output', 'error'} else b if x in {'log', 'input'} else ''
+        # In the elastic mode, each proc of the cluster writes its own output and error
+        c=b.replace('$(ClusterId)', '$(ClusterId).$(ProcId)') if self.elastic else b
+        f=lambda x: (a+c) if x in {'output', 'error'} else b if x in {'log', 'input'} else ''
         return '\n'.join( f(p.lower()).format(p) for p in self.to_pipe )
 
-    poller = None
+    def controller_ready(self):
+        return pid_file_alive(self.ipcontroller_pid_file) and os.path.exists(self.ipcontroller_json_file)
+
+    async def wait_for_controller(self, timeout=20):
+        """ Wait for the controller pid and the engine connection file without blocking """
+        return await wait_for(self.controller_ready, timeout)
+
     job_submit_time = 0
     _last_job_stat  = 0
+    job_ads = ()
+    extra_clusters = ()
+    timeline = Instance(Timeline, ())
     def start(self, n):
         # update context
-        assert wait_for_pid_file(self.ipcontroller_pid_file, 20), "Controller pid not found"
+        assert self.controller_ready(), "Controller is not ready"
+        if self.elastic:
+            self.batch_template = self.elastic_batch_template
+        self.timeline = Timeline()
         for k in self._context_keys:
             self.context[k] = getattr(self,k)
 
@@ -88,41 +125,119 @@ queue
         self.log.debug("Submitting condor job with context %s", self.context)
         ans = super().start(n)
 
-        # setup poller for job status
+        # register to the poller for job status
+        self.timeline.mark('job submitted')
         self.job_submit_time = time.time()
         self._last_job_stat  = 0
-        self.poller          = ioloop.PeriodicCallback(self.poll, 1000)
-        self.poller.start()
-        self.on_stop(lambda x: self.poller.stop())
+        self.job_ads         = ()
+        self.extra_clusters  = ()
+        self._procs_seen     = False
+        poller = JobStatusPoller.instance()
+        poller.register(self)
+        self.on_stop(lambda x: poller.unregister(self))
+        self.on_stop(self.stop_ssh_tunnel)
         return ans
 
+    @property
+    def job_ids(self):
+        " IDs of the clusters of the engines "
+        return (str(self.job_id),) + tuple(self.extra_clusters) if self.job_id else ()
+
+    def add_engines(self, n):
+        """ Submit `n` more engine procs in a new cluster (elastic mode), returns the cluster ID """
+        from .submit import submit
+        assert self.elastic and self.running, 'Engines can only be added to a running elastic cluster'
+        with open(self.batch_file, 'r') as f:
+            script = re.sub(r'^\s*queue\b.*$', 'queue %d' % int(n), f.read(), flags=re.IGNORECASE|re.MULTILINE)
+        cluster, _ = submit(script)[0]
+        self.extra_clusters += (str(cluster),)
+        self.log.info('Added %d engines in condor job %s', n, cluster)
+        return cluster
+
+    def remove_engines(self, n):
+        """ Remove `n` engine procs, idle ones first, then the latest running ones """
+        procs = sorted(self.job_ads, key=lambda ad: (ad.get('JobStatus', 0) == 2, -ad.get('ClusterId', 0), -ad.get('ProcId', 0)))
+        self.remove_procs(['%s.%s' % (ad['ClusterId'], ad['ProcId']) for ad in procs[:int(n)]])
+
+    def remove_procs(self, job_ids):
+        if not job_ids:
+            return
+        for job_id in job_ids:
+            self.release_ssh_tunnel(job_id)
+        htcondor.Schedd().act(htcondor.JobAction.Remove, list(job_ids))
+        self.log.info('Removed engine procs %s', ', '.join(job_ids))
+
+    def stop(self):
+        for cluster in self.extra_clusters:
+            try:
+                htcondor.Schedd().act(htcondor.JobAction.Remove, 'ClusterId==%s' % cluster)
+            except Exception as err:
+                self.log.error('Failed to remove condor job %s: %s', cluster, err)
+        return super().stop()
+
+    def update_job_ads(self, ads):
+        """ Called by JobStatusPoller with the current ads of the job """
+        self.job_ads = ads
+        self.poll()
+
     def poll(self):
         if not  self.running: return
+        if self.elastic:
+            return self.poll_procs()
         old_jstat = self._last_job_stat
         jstat     = self._last_job_stat = self.job_stat
         stat_changed = jstat != old_jstat
+        self.mark_job_stat(jstat)
         if stat_changed:
             if jstat == 2: #running
-                self.poller.callback_time = 20*1000
-                if not self.job_is_local and self.ssh_stat() == 'none':
+                if not self.job_is_local and str(self.job_id) not in self.ssh_tunnels:
                     try:
                         self.create_ssh_tunnel()
-                    except: #pylint: disable=W0702
+                    except Exception as err:
+                        self.log.error('Failed to create the SSH tunnel: %s', err)
                         self.stop()
             elif jstat in (3, 4, 6): # stopped. No further action on the job is needed
                 self.notify_stop(jstat)
         elif jstat != 2 and time.time() > self.job_submit_time + self.job_timeout:
             self.log.error('Condor job %s is under %s for too long', self.job_id, jstat)
             self.stop()
-        elif jstat == 2 and self.ssh_stat() == 'exited':
-            self.log.error('SSH tunnel is not alive. Exitting ...')
-            self.stop()
+
+    def poll_procs(self):
+        """ Keep a tunnel to each running engine proc, and stop when all procs have left """
+        procs = {'%s.%s' % (ad.get('ClusterId'), ad.get('ProcId')):ad for ad in self.job_ads}
+        for ad in self.job_ads:
+            self.mark_job_stat(ad.get('JobStatus', 0))
+        for job_id in tuple(self.ssh_tunnels):
+            if procs.get(job_id, {}).get('JobStatus', 0) != 2:
+                self.release_ssh_tunnel(job_id)
+        for job_id, ad in procs.items():
+            host = str(ad.get('RemoteHost', '')).split('@')[-1]
+            if ad.get('JobStatus', 0) == 2 and job_id not in self.ssh_tunnels and not is_local_host(host):
+                try:
+                    self.create_ssh_tunnel(job_id, host)
+                except Exception as err:
+                    self.log.error('Failed to create the SSH tunnel to engine %s: %s', job_id, err)
+                    # retried on the next poll, the proc is useless without a tunnel
+                    self.ssh_tunnels.pop(job_id, None)
+        if procs:
+            self._procs_seen = True
+        elif self._procs_seen:
+            self.log.info('All engine procs of condor job %s have left', self.job_id)
+            self.notify_stop(4)
+
+    def mark_job_stat(self, jstat):
+        if jstat == 1:
+            self.timeline.mark('job idle')
+        elif jstat == 2:
+            self.timeline.mark('job running')
+
+    @property
+    def remote_host(self):
+        return self.get_job_attr('RemoteHost').split('@')[-1]
 
     @property
     def job_is_local(self):
-        remote_host = self.get_job_attr('RemoteHost').split('@')[1]
-        local_host  = socket.getfqdn()
-        return remote_host.lower().find(local_host.lower())>=0
+        return is_local_host(self.remote_host)
 
     @property
     def job_stat(self):
@@ -132,73 +247,261 @@ queue
             return 0
 
     def get_job_attr(self,attrname):
-        val = subprocess.check_output(['condor_q', '-format','%s', attrname, str(self.job_id)])
-        val = val.decode(errors='ignore')
+        val = str(self.job_ads[0].get(attrname, '')) if self.job_ads else ''
         self.log.debug('Condor job %s: %s=%s ',self.job_id, attrname, val)
         return val
 
-    ssh_stderr_buf = None
-    def create_ssh_tunnel(self):
-        assert not self.ssh_to_job_proc
-        self.ssh_to_job_proc = 'Creating'
-        with open(self.ipcontroller_json_file, 'r') as f:
+    def create_ssh_tunnel(self, job_id=None, host=None):
+        """ Forward the controller ports to the execute host of a job, sharing the tunnel of other engines there """
+        job_id = str(job_id or self.job_id)
+        assert job_id not in self.ssh_tunnels
+        self.ssh_tunnels[job_id] = None
+        self.ssh_tunnels[job_id] = SshTunnels.instance().acquire(self, host or self.remote_host, job_id)
+
+    def release_ssh_tunnel(self, job_id):
+        t = self.ssh_tunnels.pop(job_id, None)
+        if t is not None:
+            SshTunnels.instance().release(job_id, t)
+
+    def stop_ssh_tunnel(self, cb_data=None): #pylint: disable=W0613
+        for job_id in tuple(self.ssh_tunnels):
+            self.release_ssh_tunnel(job_id)
+
+    def tunnel_failed(self, job_id):
+        """ Called by SshTunnel if it cannot be restarted """
+        if self.elastic:
+            self.remove_procs([job_id])
+        else:
+            self.stop()
+
+class SshTunnel(object):
+    """
+    Remote forwards of the controller ports to an execute host, shared by all
+    engine jobs running there. The forwards are opened by condor_ssh_to_job
+    to one of these jobs. The exit of condor_ssh_to_job is detected by the EOF
+    of its stderr on the ioloop; while jobs still use the tunnel, it is
+    restarted through the next job, at most `max_restarts` times in a row.
+    """
+    ports = ("registration", "control", "mux", "hb_ping", "hb_pong", "task", "iopub")
+    # Seconds for which condor_ssh_to_job must run for the tunnel to be up
+    establish_time = 2
+    max_restarts   = 3
+
+    def __init__(self, host, connection_file, loop, log):
+        self.host = host
+        self.connection_file = connection_file
+        self.loop = loop
+        self.log  = log
+        self.jobs = OrderedDict() # job id -> launcher, the tunnel goes through the first job
+        self.proc = None
+        self.pipe = None
+        self.established = False
+        self.restarts    = 0
+        self.stderr_tail = deque(maxlen=20)
+
+    def args(self, job_id):
+        with open(self.connection_file, 'r') as f:
             stat_engine=json.load( f )
         bind_addr = stat_engine['interface'].split('://')[1]
         assert bind_addr.startswith('127.')
-        args=['condor_ssh_to_job', str(self.job_id), '-N', '-v', '-o', "ExitOnForwardFailure yes"]
-        for k in ("registration", "control", "mux", "hb_ping", "hb_pong", "task", "iopub" ):
+        args=['condor_ssh_to_job', str(job_id), '-N', '-v', '-o', "ExitOnForwardFailure yes"]
+        for k in self.ports:
             args += ['-R', '{0}:{1}:{0}:{1}'.format(bind_addr, stat_engine[k])]
-
-        p=subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.ssh_to_job_proc = p
+        return args
+
+    def add(self, job_id, launcher):
+        self.jobs[job_id] = launcher
+        if self.proc is None:
+            self.start()
+
+    def remove(self, job_id):
+        self.jobs.pop(job_id, None)
+        if not self.jobs:
+            self.close()
+
+    def start(self):
+        job_id = next(iter(self.jobs))
+        p = subprocess.Popen(self.args(job_id), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.proc, self.established = p, False
+        self.stderr_tail.clear()
+        self.pipe = SubprocPipeBuf(self.loop, p, 'stderr', self._on_stderr, lambda: self._on_exit(p, job_id))
+        self.loop.call_later(self.establish_time, self._check_established, p)
+        self.log.info('condor_ssh_to_job %s started for %s (PID=%d)', job_id, self.host, p.pid)
+
+    def _on_stderr(self, l):
+        self.stderr_tail.append(l)
+        self.log.debug('[SSH %s] - %s', self.host, l.rstrip())
+
+    def _check_established(self, p):
+        if p is self.proc and p.poll() is None:
+            self.established = True
+            self.restarts    = 0
+            self.log.info('SSH tunnel to %s is established', self.host)
+            for l in tuple(self.jobs.values()):
+                l.timeline.mark('tunnel established')
+
+    def _on_exit(self, p, job_id):
+        if p is not self.proc:
+            return # closed
+        ret_code = p.poll()
+        if ret_code is None:
+            # stderr is closed just before the exit
+            self.loop.call_later(0.1, self._on_exit, p, job_id)
+            return
+        self.proc = self.pipe = None
+        if not self.jobs:
+            return
+        self.log.warning('SSH tunnel to %s through job %s exited [%d]\n\t%s',
+                         self.host, job_id, ret_code, ''.join(self.stderr_tail))
+        if job_id in self.jobs:
+            # The job may have left, try the other jobs first
+            self.jobs.move_to_end(job_id)
+        if self.restarts >= self.max_restarts:
+            self.fail()
+            return
+        self.restarts += 1
+        self.loop.call_later(self.restarts, self._restart)
+
+    def _restart(self):
+        if self.proc is not None or not self.jobs:
+            return
         try:
-            ret_code = p.wait(timeout=2)
-        except subprocess.TimeoutExpired:
-            pass
-        else:
-            out, err = tuple(x.decode(errors='ignore') for x in p.communicate(timeout=1))
-            self.ssh_to_job_proc = None
-            self.log.error('condor_ssh_to_job failed too early [%d]\n\t%s\n\t%s', ret_code, out, err)
-            raise RuntimeError(err)
-        self.on_stop(self.stop_ssh_tunnel)
-        #self.ssh_stderr = SubprocPipeBuf(self.loop, p, 'stderr').buf
-        self.ssh_stderr_buf = SubprocPipeBuf(self.loop, self.ssh_to_job_proc, 'stderr',
-            lambda l: self.log.debug('[SSH] - %s', l.rstrip()))
-        self.log.info('condor_ssh_to_job started successfully (PID=%d)', p.pid)
-
-    def ssh_stat(self):
-        p = self.ssh_to_job_proc
-        if isinstance(p, subprocess.Popen):
-            return 'running' if p.poll() is None else 'exited'
-        return 'none' if not p else 'creating'
-
-    def stop_ssh_tunnel(self, cb_data=None): #pylint: disable=W0613
-        p = self.ssh_to_job_proc
-        if self.ssh_stat() == 'running':
+            self.start()
+        except Exception as err:
+            self.log.error('Failed to restart the SSH tunnel to %s: %s', self.host, err)
+            self.fail()
+
+    def fail(self):
+        self.log.error('SSH tunnel to %s is not alive. Stopping its engines ...', self.host)
+        for job_id, l in tuple(self.jobs.items()):
+            l.tunnel_failed(job_id)
+
+    def close(self):
+        p, self.proc = self.proc, None
+        if self.pipe:
+            self.pipe.clear()
+            self.pipe = None
+        if p is not None and p.poll() is None:
             p.terminate()
             try:
-                out, err = tuple(x.decode(errors='ignore') for x in p.communicate(timeout=1))
-                self.log.debug('condor_ssh_to_job %s exited with %s: %s\n\t%s', p.pid, p.poll(), out, err)
+                p.wait(timeout=1)
+                self.log.debug('condor_ssh_to_job %s exited with %s', p.pid, p.poll())
             except subprocess.TimeoutExpired:
                 self.log.error('Fail to kill condor_ssh_to_job with pid=%d, please execute `kill %d` in a console', p.pid, p.pid)
-        if self.ssh_stderr_buf:
-            self.ssh_stderr_buf.clear()
 
+class SshTunnels(object):
+    """ SshTunnel of each execute host and controller, shared by the engine launchers """
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
 
-def wait_for_pid_file(filename, timeout=20):
-    for i in range(timeout): #pylint: disable=W0612
+    def __init__(self):
+        self.tunnels = {}
+
+    def acquire(self, launcher, host, job_id):
+        key = (host, launcher.ipcontroller_json_file)
+        t = self.tunnels.get(key, None)
+        if t is None:
+            t = self.tunnels[key] = SshTunnel(host, launcher.ipcontroller_json_file, launcher.loop, launcher.log)
         try:
-            with open(filename, 'r') as f:
-                pid = int(f.readline())
-                if check_pid(pid):
-                    return True
+            t.add(job_id, launcher)
         except Exception:
-            pass
-        time.sleep(1)
-    return False
+            self.release(job_id, t)
+            raise
+        return t
+
+    def release(self, job_id, tunnel):
+        tunnel.remove(job_id)
+        if not tunnel.jobs:
+            self.tunnels.pop((tunnel.host, tunnel.connection_file), None)
+
+
+class JobStatusPoller(object):
+    """
+    Poll the status of the jobs of all HTCondorEngineSetSshLauncher instances
+    with one schedd query per tick, and fan the job ads out to the launchers
+    """
+    attrs    = ['ClusterId', 'ProcId', 'JobStatus', 'RemoteHost']
+    interval = 1000 # ms
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.log       = logging.getLogger(__name__)
+        self.launchers = set()
+        self.callback  = None
+        self._schedd   = None
+
+    def register(self, launcher):
+        self.launchers.add(launcher)
+        if self.callback is None:
+            self.callback = ioloop.PeriodicCallback(self.poll, self.interval)
+            self.callback.start()
+
+    def unregister(self, launcher):
+        self.launchers.discard(launcher)
+        if not self.launchers and self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+    @property
+    def schedd(self):
+        if self._schedd is None:
+            self._schedd = htcondor.Schedd()
+        return self._schedd
+
+    def query(self, job_ids):
+        constraint = '||'.join('ClusterId==%s' % i for i in sorted(job_ids))
+        return self.schedd.query(constraint, self.attrs)
+
+    def poll(self):
+        launchers = [l for l in self.launchers if l.job_id]
+        if not launchers: return
+        try:
+            ads = self.query(set(i for l in launchers for i in l.job_ids))
+        except Exception as err:
+            self.log.warning('Failed to query the status of the engine jobs: %s', err)
+            self._schedd = None
+            return
+        by_cluster = {}
+        for ad in ads:
+            by_cluster.setdefault(str(ad.get('ClusterId')), []).append(ad)
+        for l in launchers:
+            try:
+                l.update_job_ads([ad for i in l.job_ids for ad in by_cluster.get(i, [])])
+            except Exception as err:
+                l.log.error('Failed to update the status of condor job %s: %s', l.job_id, err)
+
+def is_local_host(host):
+    return host.lower().find(socket.getfqdn().lower())>=0
+
+def pid_file_alive(filename):
+    try:
+        with open(filename, 'r') as f:
+            return check_pid(int(f.readline()))
+    except Exception:
+        return False
+
+async def wait_for(condition, timeout=20, interval=0.2):
+    """ Wait without blocking the event loop until `condition()` is true """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
 
 class SubprocPipeBuf:
-    def __init__(self, loop, proc, pipename='stdout', line_callback=None):
+    def __init__(self, loop, proc, pipename='stdout', line_callback=None, eof_callback=None):
         self.pipe = getattr(proc, pipename)
         self.pipe_fileno = self.pipe.fileno()
         self.buf  = None
@@ -209,6 +512,7 @@ class SubprocPipeBuf:
             self.line_callback = self.buf.write
         self.loop = loop
         self.proc = proc
+        self.eof_callback = eof_callback
         loop.add_handler(self.pipe, self._read_handler, loop.READ)
 
     def _read_handler(self, fd, evt): #pylint: disable=W0613
@@ -219,6 +523,8 @@ class SubprocPipeBuf:
                 self.line_callback(l)
                 return
         self.clear()
+        if self.eof_callback:
+            self.eof_callback()
 
     def clear(self):
         return self.loop.remove_handler(self.pipe_fileno)
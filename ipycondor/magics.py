@@ -0,0 +1,72 @@
+# Copyright 2019 Mingxuan Lin
+# Copyright 2019 Lukas Koschmieder
+" IPython magics, which import the dashboard and its dependencies on first use "
+import sys, logging
+
+from IPython.core.magic import (Magics, magics_class, line_magic, cell_magic)
+from IPython.core.magic_arguments import magic_arguments, argument, parse_argstring
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+logger.addHandler(ch)
+
+@magics_class
+class CondorMagics(Magics):
+    _condor = None
+    @magic_arguments()
+    @argument('-o', '--output', help='Variable to store the list of cluster IDs in')
+    @argument('--wait', action='store_true', help='Block until the jobs are submitted')
+    @cell_magic
+    def CondorJob(self, line, cell):
+        """
+        Creation of condor jobs from a submit description.
+        All queue statements of the cell are submitted in one transaction in
+        the background, each as a cluster of its own (condor_submit makes one
+        cluster of the file); the cluster IDs are logged and stored in `--output`.
+        """
+        from .submit import submit_async
+        args = parse_argstring(self.CondorJob, line)
+        c = self._condor
+        fut = submit_async(cell, c.schedd if c is not None else None)
+        def done(f):
+            if f.exception():
+                logger.error('Failed to submit the jobs: %s', f.exception())
+                return
+            logger.info('Submitted %s', ', '.join('cluster %d (%d jobs)' % r for r in f.result()))
+            if args.output:
+                self.shell.user_ns[args.output] = [cluster for cluster, _ in f.result()]
+        if args.wait:
+            fut.exception()
+            done(fut)
+            return [cluster for cluster, _ in fut.result()]
+        fut.add_done_callback(done)
+
+    @line_magic
+    def CondorMon(self,line):
+        "Display the Condor dashboard"
+        return self.condor.dashboard()
+
+    @property
+    def condor(self):
+        Condor = bind_condor()
+        c = getattr(self,'_condor', None)
+        if not isinstance(c, Condor):
+            c = Condor()
+            self._condor = c
+        return c
+
+def bind_condor():
+    """
+    Import the class `Condor` and bind it to the package attribute, which the
+    import of the submodule `ipycondor.Condor` sets to the submodule
+    """
+    from .Condor import Condor
+    sys.modules[__package__].Condor = Condor
+    return Condor
+
+def load_ipython_extension(ip):
+    if __package__ + '.Condor' in sys.modules:
+        # Loaded as the extension `ipycondor.Condor`
+        bind_condor()
+    ip.register_magics(CondorMagics)
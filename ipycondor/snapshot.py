@@ -0,0 +1,96 @@
+# Copyright 2019 Mingxuan Lin
+" Snapshots of the tables on disk, from which a new dashboard starts "
+import os, time, datetime, hashlib, logging
+
+import pandas as pd
+
+from .tables import indexed
+
+logger = logging.getLogger(__name__)
+
+def _feather():
+    try:
+        import pyarrow #pylint: disable=W0611
+        return True
+    except ImportError:
+        return False
+
+class SnapshotStore(object):
+    """
+    Directory of table snapshots keyed by the daemon, constraint and columns
+
+    The tables are written in the Feather format if pyarrow is available,
+    otherwise as pickles. Each snapshot is replaced atomically, and its
+    modification time is the time of the query.
+
+    Usage:
+        store = SnapshotStore('~/.cache/ipycondor')
+        key = store.key('schedd', 'Owner=="me"', columns, index)
+        store.save(key, df)
+        df, t = store.load(key)
+    """
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.ext = '.feather' if _feather() else '.pkl'
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.ext)
+
+    def load(self, key):
+        """ The table saved under `key` with its index reset, and the time it was saved; or (None, None) """
+        p = self.path(key)
+        try:
+            t = os.path.getmtime(p)
+            df = pd.read_feather(p) if self.ext == '.feather' else pd.read_pickle(p)
+        except Exception as err:
+            logger.debug('No snapshot %s: %s', p, err)
+            return None, None
+        return df, datetime.datetime.fromtimestamp(t)
+
+    def save(self, key, df):
+        os.makedirs(self.directory, exist_ok=True)
+        p = self.path(key)
+        tmp = '%s.%d.tmp' % (p, os.getpid())
+        flat = df.reset_index()
+        if self.ext == '.feather':
+            flat.to_feather(tmp)
+        else:
+            flat.to_pickle(tmp)
+        os.replace(tmp, p)
+
+class SnapshotTable(object):
+    """
+    Table source which returns the snapshot of the table on its first call,
+    and saves the results of the underlying source `f` at most every
+    `save_interval` seconds. `snapshot_time` is the time of the snapshot if the
+    last call returned it, otherwise None.
+    """
+    save_interval = 60
+
+    def __init__(self, f, store, key, key_cols):
+        self.f        = f
+        self.store    = store
+        self.key      = key
+        self.key_cols = tuple(key_cols)
+        self.snapshot_time = None
+        self.last_save = None
+
+    def __call__(self):
+        if self.last_save is None and self.snapshot_time is None:
+            df, t = self.store.load(self.key)
+            if df is not None:
+                self.snapshot_time = t
+                return indexed(df, self.key_cols)
+        df = self.f()
+        self.snapshot_time = None
+        if self.last_save is None or time.time() > self.last_save + self.save_interval:
+            self.last_save = time.time()
+            try:
+                self.store.save(self.key, df)
+            except Exception as err:
+                logger.warning('Failed to save the snapshot of the table: %s', err)
+        return df
@@ -0,0 +1,75 @@
+# Copyright 2019 Mingxuan Lin
+" Job submission through the htcondor python bindings instead of condor_submit "
+import re, logging
+from concurrent.futures import ThreadPoolExecutor
+
+import htcondor
+
+logger = logging.getLogger(__name__)
+
+_QUEUE = re.compile(r'^\s*queue\b(.*)$', re.IGNORECASE)
+_ITEMS = re.compile(r'\b(in|from|matching)\b', re.IGNORECASE)
+
+_executor = None
+def executor():
+    " Single thread running the submissions in order "
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ipycondor-submit')
+    return _executor
+
+def split_queues(text):
+    """
+    Submit descriptions of the queue statements in `text`. As for
+    condor_submit, the commands before a queue statement apply to all
+    following queue statements.
+    """
+    commands, descs, queue = [], [], None
+    for line in text.splitlines():
+        if queue is not None:
+            # Item list spanning several lines, closed by ')'
+            queue.append(line)
+            if line.strip().startswith(')'):
+                descs.append('\n'.join(commands + queue))
+                queue = None
+        elif _QUEUE.match(line):
+            if line.count('(') > line.count(')'):
+                queue = [line]
+            else:
+                descs.append('\n'.join(commands + [line]))
+        else:
+            commands.append(line)
+    return descs
+
+def _count(qargs):
+    m = re.match(r'\s*(\d+)', qargs)
+    return int(m.group(1)) if m else 1
+
+def submit(text, schedd=None):
+    """
+    Submit the jobs of all queue statements in `text` in one schedd transaction,
+    including the items of `queue ... in/from/matching` statements.
+    Unlike condor_submit, which puts all jobs of a file in one cluster, each
+    queue statement is a cluster of its own.
+
+    :param text: submit description as for condor_submit
+    :param schedd: htcondor.Schedd, the local one by default
+    :return: list of (cluster ID, number of jobs)
+    """
+    subs = [htcondor.Submit(d) for d in split_queues(text)]
+    if not subs:
+        raise ValueError('No queue statement in the submit description')
+    schedd = schedd or htcondor.Schedd()
+    results = []
+    with schedd.transaction() as txn:
+        for sub in subs:
+            qargs = sub.getQArgs()
+            items = sub.itemdata() if _ITEMS.search(qargs) else None
+            res = sub.queue_with_itemdata(txn, _count(qargs), items)
+            results.append((res.cluster(), res.num_procs()))
+    logger.debug('Submitted %s', ', '.join('cluster %d (%d jobs)' % r for r in results))
+    return results
+
+def submit_async(text, schedd=None):
+    " submit in a background thread, returns a concurrent.futures.Future "
+    return executor().submit(submit, text, schedd)
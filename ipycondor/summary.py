@@ -0,0 +1,57 @@
+# Copyright 2019 Mingxuan Lin
+" Aggregated views of the jobs and slots, computed with vectorized group-bys "
+import pandas as pd
+
+from .ClassAdParser import QueryParser
+
+# Attributes projected for the summaries
+JOB_ATTRS  = ('Owner', 'JobStatus', 'JobUniverse')
+SLOT_ATTRS = ('Machine', 'State', 'Cpus', 'Memory')
+
+def raw_frame(classAds, attrs):
+    " DataFrame of the unparsed attributes of ClassAd objects "
+    classAds = classAds if isinstance(classAds, list) else list(classAds)
+    return pd.DataFrame({a:[j.get(a, None) for j in classAds] for a in attrs}, columns=attrs)
+
+def job_frame(classAds):
+    """ Owner, JobStatus, JobUniverse and the execute host of jobs """
+    classAds = classAds if isinstance(classAds, list) else list(classAds)
+    df = QueryParser().compile(JOB_ATTRS).to_frame(classAds)
+    host = raw_frame(classAds, ('RemoteHost',))['RemoteHost']
+    df['Host'] = host.map(lambda h: h.split('@')[-1] if isinstance(h, str) else None)
+    return df
+
+def _counts(df):
+    df.columns = df.columns.astype(str)
+    df['Total'] = df.sum(axis=1)
+    return df
+
+def by_owner_status(jobs):
+    """ Number of jobs of each owner in each state """
+    return _counts(pd.crosstab(jobs['Owner'], jobs['JobStatus']))
+
+def by_universe(jobs):
+    """ Number of jobs of each universe in each state """
+    return _counts(pd.crosstab(jobs['JobUniverse'], jobs['JobStatus']))
+
+def by_machine(jobs):
+    """ Number of running jobs of each owner on each execute host """
+    running = jobs[jobs['Host'].notna()]
+    return _counts(pd.crosstab(running['Host'], running['Owner']))
+
+def machine_usage(slots):
+    """
+    Claimed and total CPUs and memory (MB) of each machine over all its slots.
+    The unclaimed resources of a partitionable slot are in the slot itself,
+    and the claimed ones in its dynamic slots.
+    """
+    claimed = slots['State'] == 'Claimed'
+    res = pd.DataFrame({
+        'ClaimedCpus':   slots['Cpus'].where(claimed, 0),
+        'TotalCpus':     slots['Cpus'],
+        'ClaimedMemory': slots['Memory'].where(claimed, 0),
+        'TotalMemory':   slots['Memory']})
+    g = res.groupby(slots['Machine'])
+    usage = g.sum()
+    usage.insert(0, 'Slots', g.size())
+    return usage.sort_index()
@@ -0,0 +1,338 @@
+# Copyright 2019 Mingxuan Lin
+" Data sources for the tables of the dashboard "
+import time, logging
+
+import pandas as pd
+
+from .ClassAdParser import QueryParser
+
+logger = logging.getLogger(__name__)
+
+def indexed(df, key_cols):
+    """ Set the key columns as the (sorted) index of a table """
+    indx = list(key_cols)
+    if len(df)==0:
+        indx = indx[:1]
+    if indx:
+        df.set_index(indx, inplace=True)
+        df.sort_index(inplace=True)
+    return df
+
+def concat(frames):
+    """ pandas.concat keeping the categorical columns categorical """
+    out = pd.concat(frames)
+    for c in frames[0].columns:
+        # concat falls back to object dtype if the categories differ
+        if isinstance(frames[0][c].dtype, pd.CategoricalDtype) and not isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype('category')
+    return out
+
+def upsert(df, rows):
+    """ Replace or insert `rows` into `df` by index """
+    return concat([df[~df.index.isin(rows.index)], rows]).sort_index()
+
+def fingerprint(df):
+    """ 64-bit hash of each row of `df` (including its index), indexed like `df` """
+    return pd.util.hash_pandas_object(df, index=True)
+
+class TableDiff(object):
+    """
+    Difference between two versions of a table by index:
+    the index of the `inserted`, `deleted` and `changed` rows, the `columns`
+    which differ in the changed rows (or in the schema), and the
+    `fingerprint` of the new version
+    """
+    def __init__(self, inserted, deleted, changed, columns, fingerprint): #pylint: disable=W0621
+        self.inserted = inserted
+        self.deleted  = deleted
+        self.changed  = changed
+        self.columns  = columns
+        self.fingerprint = fingerprint
+
+    def __bool__(self):
+        return bool(len(self.inserted) or len(self.deleted) or len(self.changed) or self.columns)
+
+    def __repr__(self):
+        return '<TableDiff +%d -%d ~%d %s>' % (len(self.inserted), len(self.deleted), len(self.changed), list(self.columns))
+
+def _equal(a, b):
+    """ Whether the aligned series `a` and `b` have equal values, regardless of their dtypes
+    (e.g. categoricals with different categories) """
+    na = a.isna().values
+    if not (na == b.isna().values).all():
+        return False
+    return bool((a.astype(object).values[~na] == b.astype(object).values[~na]).all())
+
+def diff(old, new, old_fp=None):
+    """
+    TableDiff of the tables `old` and `new`, whose indexes must be unique.
+    Only the rows whose fingerprints differ are compared column by column.
+    `old_fp` is the fingerprint of `old` if known.
+    """
+    old_fp = fingerprint(old) if old_fp is None else old_fp
+    new_fp = fingerprint(new)
+    columns = [c for c in new.columns if c not in old.columns] + [c for c in old.columns if c not in new.columns]
+    if new_fp.index.equals(old_fp.index):
+        common, a, b = new_fp.index, old_fp.values, new_fp.values
+    else:
+        common = new_fp.index.intersection(old_fp.index)
+        a, b = old_fp.loc[common].values, new_fp.loc[common].values
+    changed = common[a != b]
+    if len(changed):
+        a, b = old.loc[changed], new.loc[changed]
+        columns += [c for c in new.columns if c in old.columns and not _equal(a[c], b[c])]
+    return TableDiff(new_fp.index.difference(old_fp.index), old_fp.index.difference(new_fp.index),
+                     changed, columns, new_fp)
+
+def _server_time(classAds):
+    for j in classAds:
+        t = j.get('ServerTime', None)
+        if isinstance(t, int):
+            return t
+    return int(time.time())
+
+class IncrementalTable(object):
+    """
+    Job table which is refreshed incrementally
+
+    The first call loads the whole queue. Subsequent calls only fetch the jobs
+    whose `EnteredCurrentStatus` moved since the last sync and upsert them into
+    the table, and drop the jobs which have left the queue.
+    The whole queue is reloaded every `resync_interval` seconds for safety.
+
+    Usage:
+        f = IncrementalTable(condor.jobs, 'Owner=="me"', columns, ('ClusterID','ProcID'))
+        df = f()
+    """
+    changed_attr = 'EnteredCurrentStatus'
+    # Tolerated clock skew between the schedd and this host in seconds
+    slack = 5
+
+    def __init__(self, classAds_hdl, constraint, columns, key_cols, resync_interval=300, parser=None, schema=None):
+        parser = self.parser = parser or QueryParser()
+        self.classAds_hdl = classAds_hdl
+        self.constraint   = constraint
+        self.key_cols     = tuple(key_cols)
+        self.plan         = parser.compile(columns, schema)
+        self.key_plan     = parser.compile(self.key_cols, schema)
+        self.resync_interval = resync_interval
+        self.table     = None
+        self.last_sync = 0 # ServerTime of the last sync
+        self.last_full = 0 # Local time of the last full reload
+
+    def __call__(self):
+        if self.table is None or time.time() > self.last_full + self.resync_interval:
+            self.reload()
+        else:
+            self.update()
+        return self.current()
+
+    def current(self):
+        """ The table as of the last sync """
+        if len(self.table)==0:
+            return indexed(self.table.reset_index(), self.key_cols)
+        return self.table
+
+    def _frame(self, plan, classAds):
+        df = plan.to_frame(classAds)
+        df.set_index(list(self.key_cols), inplace=True)
+        return df
+
+    def _where(self, expr):
+        return '({0})&&({1})'.format(self.constraint, expr) if self.constraint else expr
+
+    def reload(self):
+        ads = self.classAds_hdl(self.constraint, self.plan.attrs + ('ServerTime',))
+        self.last_sync = _server_time(ads)
+        self.last_full = time.time()
+        self.table = self._frame(self.plan, ads).sort_index()
+        logger.debug('Reloaded %d jobs', len(self.table))
+
+    def update(self):
+        # Query the keys before the changes, so that jobs entering the queue
+        # in between are not dropped
+        keys = self.classAds_hdl(self.constraint, self.key_cols + ('ServerTime',))
+        since = self.last_sync - self.slack
+        self.last_sync = _server_time(keys)
+        changed = self.classAds_hdl(self._where('{0} >= {1}'.format(self.changed_attr, since)),
+                                    self.plan.attrs)
+
+        present = self.table.index.isin(self._frame(self.key_plan, keys).index)
+        table = self.table if present.all() else self.table[present]
+        if len(changed) > 0:
+            table = upsert(table, self._frame(self.plan, changed))
+        logger.debug('Updated %d jobs, dropped %d jobs', len(changed), (~present).sum())
+        self.table = table
+
+class HistoryTable(object):
+    """
+    Job history streamed from the schedd in chunks
+
+    `load` iterates over `history_hdl(constraint, projection, match)` and
+    parses every `chunk_size` job ads into a DataFrame, so that only one chunk
+    of ads is held at a time. The table is published through the callback
+    `show(table, n, done)` at most every `show_interval` seconds while the
+    history is streaming. A new `load` stops the one running.
+
+    Usage:
+        f = HistoryTable(condor.history, 'Owner=="me"', columns, ('ClusterID','ProcID'))
+        f.load(lambda df, n, done: print(n))
+        df = f()
+    """
+    chunk_size    = 5000
+    show_interval = 1
+
+    def __init__(self, history_hdl, constraint, columns, key_cols, match=10000, parser=None, schema=None):
+        parser = parser or QueryParser()
+        self.history_hdl = history_hdl
+        self.constraint  = constraint
+        self.key_cols    = tuple(key_cols)
+        self.plan        = parser.compile(columns, schema)
+        self.match       = match
+        self.loaded      = 0
+        self.table       = self._frame([])
+        self._generation = 0
+
+    def __call__(self):
+        return self.table
+
+    def _frame(self, classAds):
+        df = self.plan.to_frame(classAds)
+        return df.set_index(list(self.key_cols)) if len(df) else indexed(df, self.key_cols)
+
+    def load(self, show=None):
+        """ Stream the history into the table, returns the number of jobs loaded """
+        self._generation += 1
+        gen = self._generation
+        frames, chunk, n = [], [], 0
+        shown = time.time()
+        for ad in self.history_hdl(self.constraint, self.plan.attrs, self.match):
+            if gen != self._generation:
+                logger.debug('History loading stopped after %d jobs', n)
+                return n
+            chunk.append(ad)
+            if len(chunk) < self.chunk_size:
+                continue
+            frames.append(self._frame(chunk))
+            n += len(chunk)
+            chunk = []
+            if self.match >= 0 and n >= self.match:
+                break
+            if show and time.time() > shown + self.show_interval:
+                # Merge the chunks, so that each one is copied once per show
+                frames = [concat(frames)]
+                self.table, self.loaded = frames[0], n
+                show(self.table, n, False)
+                shown = time.time()
+        if gen != self._generation:
+            return n
+        if chunk:
+            frames.append(self._frame(chunk))
+        table = concat(frames) if frames else self._frame([])
+        if self.match >= 0:
+            table = table.iloc[:self.match]
+        self.table, self.loaded = table, len(table)
+        if show:
+            show(self.table, self.loaded, True)
+        logger.debug('Loaded the history of %d jobs', self.loaded)
+        return self.loaded
+
+def _literal(v):
+    if isinstance(v, str):
+        return '"%s"' % v.replace('\\', '\\\\').replace('"', '\\"')
+    return str(v)
+
+def _lex_cmp(keys, values, op):
+    """ ClassAd expression comparing the tuple of attributes `keys` lexicographically with `values` """
+    k, v = keys[0], _literal(values[0])
+    if len(keys)==1:
+        return '{0} {1}= {2}'.format(k, op, v)
+    return '({0} {1} {2} || {0} == {2} && ({3}))'.format(k, op, v, _lex_cmp(keys[1:], values[1:], op))
+
+class PagedTable(object):
+    """
+    Window of a job table for queues too large to be shown at once
+
+    Only the key columns (and the sort attribute) of the matching jobs are
+    queried for the whole queue. All attributes are fetched and parsed only for
+    the visible page plus a prefetch margin on each side, with a key-range
+    constraint and the query limit. Filtering runs in the schedd through the
+    ClassAd expression `filter`; since the schedd does not sort its results,
+    the projected keys are sorted here.
+
+    Usage:
+        f = PagedTable(condor.jobs, '', columns, ('ClusterID','ProcID'), page_size=100)
+        f.filter = 'JobStatus == 5'
+        f.page   = 2
+        df = f()
+    """
+    def __init__(self, classAds_hdl, constraint, columns, key_cols, page_size=100, prefetch=100, parser=None, schema=None):
+        parser = parser or QueryParser()
+        self.classAds_hdl = classAds_hdl
+        self.constraint   = constraint
+        self.key_cols     = tuple(key_cols)
+        self.plan         = parser.compile(columns, schema)
+        self.page_size    = page_size
+        self.prefetch     = prefetch
+        self.page      = 0
+        self.filter    = ''
+        self.sort_by   = None # attribute name, None for the key columns
+        self.ascending = True
+        self.total     = 0
+        self._window   = None # (first row, number of keys, rows) of the last fetched window
+
+    @property
+    def pages(self):
+        return max(1, -(-self.total // self.page_size))
+
+    def _where(self):
+        c = ['(%s)' % x for x in (self.constraint, self.filter) if x]
+        return '&&'.join(c)
+
+    def keys(self):
+        """ Sorted keys of all jobs matching the constraint and filter """
+        by = [self.sort_by] if self.sort_by else []
+        attrs = self.key_cols + tuple(a for a in by if a not in self.key_cols)
+        ads = self.classAds_hdl(self._where(), attrs)
+        keys = pd.DataFrame({a:[j.get(a, None) for j in ads] for a in attrs}, columns=attrs)
+        keys.sort_values(by + [k for k in self.key_cols if k not in by], ascending=self.ascending, inplace=True)
+        return keys.set_index(list(self.key_cols)).index
+
+    def cached_page(self):
+        """ The current page from the last fetched window, or None if it is not covered """
+        if self._window is None:
+            return None
+        first, n, rows = self._window
+        start = self.page * self.page_size - first
+        if start < 0 or (start + self.page_size > n and first + n < self.total):
+            return None
+        return rows.iloc[start:start+self.page_size]
+
+    def __call__(self):
+        keys = self.keys()
+        self.total = len(keys)
+        self.page  = min(self.page, self.pages-1)
+        first = max(0, self.page*self.page_size - self.prefetch)
+        window = keys[first:(self.page+1)*self.page_size + self.prefetch]
+        if len(window)==0:
+            self._window = (0, 0, indexed(self.plan.to_frame([]), self.key_cols))
+            return self._window[2]
+
+        if self.sort_by in (None, self.key_cols[0]):
+            # The window is a range of the keys in their order
+            lo, hi = min(window), max(window)
+            expr = '{0} && {1}'.format(_lex_cmp(self.key_cols, _tuple(lo), '>'), _lex_cmp(self.key_cols, _tuple(hi), '<'))
+        else:
+            expr = '||'.join('(%s)' % '&&'.join('%s==%s' % (k, _literal(v)) for k, v in zip(self.key_cols, _tuple(w)))
+                             for w in window)
+        where = self._where()
+        ads = self.classAds_hdl('(%s)&&(%s)' % (where, expr) if where else expr, self.plan.attrs, len(window))
+        rows = self.plan.to_frame(ads).set_index(list(self.key_cols))
+        # Keep the sort order of the keys, and drop the jobs which have left in between
+        rows = rows.reindex(window[window.isin(rows.index)])
+        self._window = (first, len(window), rows)
+        start = self.page*self.page_size - first
+        return rows.iloc[start:start+self.page_size]
+
+def _tuple(k):
+    return k if isinstance(k, tuple) else (k,)
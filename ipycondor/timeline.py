@@ -0,0 +1,26 @@
+# Copyright 2019 Mingxuan Lin
+" Timestamps of the stages of a process, e.g. launching an ipcluster "
+import time
+from collections import OrderedDict
+
+class Timeline(object):
+    """
+    Time of each stage, recorded at its first occurrence
+
+    Usage:
+        t = Timeline()
+        t.mark('job submitted')
+        t.latency(('start', 'job submitted', 'job running'))
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def mark(self, stage, t=None):
+        if stage not in self.stages:
+            self.stages[stage] = time.time() if t is None else t
+
+    def latency(self, order, stages=None):
+        """ Seconds from the previous recorded stage in `order` to each recorded stage """
+        stages = self.stages if stages is None else stages
+        seen = [(s, stages[s]) for s in order if s in stages]
+        return OrderedDict((s, t - t0) for (s, t), (_, t0) in zip(seen[1:], seen))